@@ -0,0 +1,66 @@
+# encoding: utf-8
+
+"""
+The ``related_<name>`` and ``<field>_history`` shortcuts on versioned models.
+
+These are descriptors, added to each versioned model when Django prepares
+the class, rather than something we work out in ``__getattr__``: Django
+looks up (and misses) lots of cache attributes on model instances, and
+every one of those misses would otherwise go through our string juggling.
+
+* ``<attname>_history`` for every field, see ``_get_attribute_history``
+* ``related_<name>`` for every many-to-many field on a versioned model and
+  for every reverse relation to it, see ``_get_related_objects``
+
+Reverse relations only exist once the model on the other side is prepared,
+so we install those through Django's own lazy relation mechanism.
+"""
+
+from django.db.models.fields.related import add_lazy_relation
+
+
+class HistoryAccessor(object):
+    def __init__(self, attname):
+        self.attname = attname
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return instance._get_attribute_history(self.attname)
+
+
+class RelatedAccessor(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return instance.related_objects(self.name)
+
+
+def is_versioned(model):
+    return hasattr(model, 'Versioning') and not model._meta.abstract
+
+def install(model, name, accessor):
+    # never shadow anything a model (or one of its parents) defines itself
+    if not hasattr(model, name):
+        setattr(model, name, accessor)
+
+def install_related_accessor(field, model, cls):
+    accessor_name = field.related.get_accessor_name()
+    # reverse one-to-one relations, like parent links, aren't managers
+    if is_versioned(model) and field.rel.multiple and not field.rel.is_hidden():
+        install(model, 'related_' + accessor_name, RelatedAccessor(accessor_name))
+
+def install_accessors(sender, **kwargs):
+    if sender._meta.abstract:
+        return
+    if is_versioned(sender):
+        for field in sender._meta.fields:
+            install(sender, field.attname + '_history', HistoryAccessor(field.attname))
+        for field in sender._meta.many_to_many:
+            install(sender, 'related_' + field.name, RelatedAccessor(field.name))
+    for field in sender._meta.local_fields + sender._meta.local_many_to_many:
+        if field.rel:
+            add_lazy_relation(sender, field, field.rel.to, install_related_accessor)
@@ -0,0 +1,346 @@
+# encoding: utf-8
+
+"""
+Diffing revisions.
+
+``difflib`` works fine for short texts, but both ``SequenceMatcher`` and
+``HtmlDiff`` slow down dramatically on long ones. This module implements
+Myers' O(ND) diff algorithm instead, which is fast when two texts are
+similar, as revisions of the same content tend to be. On texts that have
+very little in common, it gives up once it runs out of its time budget and
+reports everything in between the common beginning and end as replaced.
+
+Texts can be compared by line, word or character::
+
+    >>> list(chunks(u"The quick brown fox", u"The slow brown fox"))
+    [('equal', u'The ', u'The '), ('replace', u'quick', u'slow'), ('equal', u' brown fox', u' brown fox')]
+
+``opcodes`` yields the same kind of opcodes as ``SequenceMatcher.get_opcodes``,
+``unified`` yields the lines of a unified diff and ``html`` yields inline
+HTML with ``<del>`` and ``<ins>`` tags. All of these are generators.
+``diff_revisions`` compares every field of two revisions in one go, and
+``cached_diffs`` does the same for many pairs of revisions, caching the
+results so that diffs are only ever computed once.
+"""
+
+import re
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.hashcompat import md5_constructor
+from django.utils.html import escape
+
+GRANULARITIES = ('line', 'word', 'char')
+# the maximum amount of seconds spent looking for the shortest diff
+TIMEOUT = 1.0
+
+WORDS = re.compile(r'\s+|\w+|[^\w\s]', re.UNICODE)
+
+
+def tokenize(text, granularity='word'):
+    if granularity == 'line':
+        return text.splitlines(True)
+    elif granularity == 'word':
+        return WORDS.findall(text)
+    elif granularity == 'char':
+        return list(text)
+    else:
+        raise ValueError("Unknown granularity %r, choose one of %s" % (granularity, ", ".join(GRANULARITIES)))
+
+def _intern(a, b):
+    """ Replaces tokens with integers, which are a lot faster to compare. """
+    ids = {}
+    return [ids.setdefault(token, len(ids)) for token in a], [ids.setdefault(token, len(ids)) for token in b]
+
+def _myers(a, b, deadline=None):
+    """ The matching blocks of the shortest edit script between two sequences,
+    as ``(i, j, size)`` tuples, or None if we ran out of time. """
+
+    n, m = len(a), len(b)
+    offset = n + m + 1
+    v = [0] * (2 * offset + 1)
+    trace = []
+    for d in xrange(n + m + 1):
+        if deadline is not None and time.time() > deadline:
+            return None
+        trace.append(v[offset - d - 1:offset + d + 2])
+        for k in xrange(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                return _backtrack(trace, n, m)
+
+def _backtrack(trace, n, m):
+    blocks = []
+    x, y = n, m
+    for d in xrange(len(trace) - 1, -1, -1):
+        # trace[d] holds v[-d - 1:d + 2] as it was before step d
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v[k + d] < v[k + d + 2]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v[prev_k + d + 1]
+        prev_y = prev_x - prev_k
+        # each step is a single insertion or deletion followed by a 
+        # (possibly empty) diagonal of matching elements
+        size = min(x - prev_x, y - prev_y)
+        if size > 0:
+            blocks.append((x - size, y - size, size))
+        x, y = prev_x, prev_y
+    blocks.reverse()
+    return blocks
+
+def _to_opcodes(blocks, n, m):
+    i = j = 0
+    for bi, bj, size in blocks + [(n, m, 0)]:
+        if i < bi and j < bj:
+            yield ('replace', i, bi, j, bj)
+        elif i < bi:
+            yield ('delete', i, bi, j, bj)
+        elif j < bj:
+            yield ('insert', i, bi, j, bj)
+        if size:
+            yield ('equal', bi, bi + size, bj, bj + size)
+        i, j = bi + size, bj + size
+
+def opcodes(a, b, timeout=TIMEOUT):
+    """
+    Compares two sequences and yields ``(tag, i1, i2, j1, j2)`` tuples
+    that describe how to turn ``a`` into ``b``, just like
+    ``difflib.SequenceMatcher.get_opcodes``.
+    """
+
+    a, b = _intern(a, b)
+    n, m = len(a), len(b)
+
+    # texts usually have a lot in common at their beginning and end,
+    # which is a lot cheaper to find than anything else
+    prefix = 0
+    while prefix < n and prefix < m and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < n - prefix and suffix < m - prefix and a[n - suffix - 1] == b[m - suffix - 1]:
+        suffix += 1
+
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+    blocks = _myers(a[prefix:n - suffix], b[prefix:m - suffix], deadline)
+    if blocks is None:
+        blocks = []
+    blocks = [(i + prefix, j + prefix, size) for i, j, size in blocks]
+    if prefix:
+        blocks.insert(0, (0, 0, prefix))
+    if suffix:
+        blocks.append((n - suffix, m - suffix, suffix))
+    return _to_opcodes(blocks, n, m)
+
+def _chunks(a, b, granularity, timeout):
+    if granularity not in GRANULARITIES:
+        raise ValueError("Unknown granularity %r, choose one of %s" % (granularity, ", ".join(GRANULARITIES)))
+
+    if granularity == 'line':
+        a, b = tokenize(a, granularity), tokenize(b, granularity)
+        for tag, i1, i2, j1, j2 in opcodes(a, b, timeout):
+            yield tag, u''.join(a[i1:i2]), u''.join(b[j1:j2])
+        return
+
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+    for tag, old, new in _chunks(a, b, 'line', timeout):
+        if tag != 'replace':
+            yield tag, old, new
+            continue
+        remaining = None
+        if deadline is not None:
+            remaining = max(deadline - time.time(), 0)
+        old_tokens, new_tokens = tokenize(old, granularity), tokenize(new, granularity)
+        for tag, i1, i2, j1, j2 in opcodes(old_tokens, new_tokens, remaining):
+            yield tag, u''.join(old_tokens[i1:i2]), u''.join(new_tokens[j1:j2])
+
+def chunks(a, b, granularity='word', timeout=TIMEOUT):
+    """ Compares two texts and yields ``(tag, old, new)`` tuples, where
+    ``old`` and ``new`` are the bits of text the opcode refers to. 
+
+    Word and character diffs compare lines first, and only look at the words
+    or characters of lines that changed, which is a lot faster on long texts. """
+
+    previous = None
+    for chunk in _chunks(a, b, granularity, timeout):
+        if previous is None:
+            previous = chunk
+        elif previous[0] == chunk[0]:
+            previous = (chunk[0], previous[1] + chunk[1], previous[2] + chunk[2])
+        else:
+            yield previous
+            previous = chunk
+    if previous is not None:
+        yield previous
+
+def _group(codes, n=3):
+    """ Groups opcodes into hunks with up to ``n`` lines of context,
+    like ``SequenceMatcher.get_grouped_opcodes``. """
+
+    codes = list(codes)
+    if not codes:
+        codes = [('equal', 0, 1, 0, 1)]
+    if codes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    if codes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal' and i2 - i1 > n * 2:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        yield group
+
+def unified(a, b, fromfile='', tofile='', n=3, timeout=TIMEOUT):
+    """ Yields the lines of a unified diff between two texts. """
+
+    a, b = tokenize(a, 'line'), tokenize(b, 'line')
+    started = False
+    for group in _group(opcodes(a, b, timeout), n):
+        if not started:
+            started = True
+            yield '--- %s\n' % fromfile
+            yield '+++ %s\n' % tofile
+        first, last = group[0], group[-1]
+        yield '@@ -%i,%i +%i,%i @@\n' % (first[1] + 1, last[2] - first[1], first[3] + 1, last[4] - first[3])
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                for line in a[i1:i2]:
+                    yield ' ' + line
+                continue
+            for line in a[i1:i2]:
+                yield '-' + line
+            for line in b[j1:j2]:
+                yield '+' + line
+
+def hunks(chunks, context=3):
+    """
+    Groups chunks into hunks: changes, with up to ``context`` lines of 
+    unchanged text around them. Unchanged text further away from any 
+    change is left out.
+    """
+
+    chunks = list(chunks)
+    hunk = []
+    for i, (tag, old, new) in enumerate(chunks):
+        if tag != 'equal':
+            hunk.append((tag, old, new))
+            continue
+        lines = old.splitlines(True)
+        first, last = i == 0, i == len(chunks) - 1
+        if not first and not last and len(lines) <= context * 2:
+            hunk.append((tag, old, new))
+            continue
+        if not first and context:
+            head = u''.join(lines[:context])
+            hunk.append((tag, head, head))
+        if hunk:
+            yield hunk
+        hunk = []
+        if not last and context:
+            tail = u''.join(lines[-context:])
+            hunk.append((tag, tail, tail))
+    if [chunk for chunk in hunk if chunk[0] != 'equal']:
+        yield hunk
+
+def render_html(chunks):
+    """ Yields escaped HTML for a list of chunks, showing the changes inline
+    with ``<del>`` and ``<ins>`` tags. """
+
+    for tag, old, new in chunks:
+        if tag == 'equal':
+            yield escape(old)
+            continue
+        if old:
+            yield u'<del>%s</del>' % escape(old)
+        if new:
+            yield u'<ins>%s</ins>' % escape(new)
+
+def html(a, b, granularity='word', timeout=TIMEOUT):
+    """ Yields escaped HTML that shows the changes between two texts inline. """
+    return render_html(chunks(a, b, granularity, timeout))
+
+def get_fields(model):
+    return [field.name for field in model._meta.fields if field.editable and not field.primary_key]
+
+def get_values(old, new, name):
+    a, b = getattr(old, name), getattr(new, name)
+    if a == b:
+        return None
+    a = a is not None and unicode(a) or u''
+    b = b is not None and unicode(b) or u''
+    return a, b
+
+def diff_revisions(old, new, fields=None, granularity='word', timeout=TIMEOUT):
+    """
+    Compares two revisions (or any two model instances of the same kind), and
+    returns a list of ``(field name, chunks)`` tuples for the fields that changed,
+    with chunks as returned by ``chunks``. Defaults to all editable fields.
+    """
+
+    changes = []
+    for name in fields or get_fields(old):
+        values = get_values(old, new, name)
+        if values is not None:
+            changes.append((name, chunks(values[0], values[1], granularity, timeout)))
+    return changes
+
+def get_cache_key(old, new, name, granularity, values):
+    # The key includes the values we're comparing, so a diff is never out of date,
+    # even if a revision is updated in place or its primary key gets reused.
+    digest = md5_constructor()
+    for part in (old._meta.app_label, old._meta.object_name, old.pk, new.pk, name, granularity) + values:
+        digest.update(unicode(part).encode('utf-8'))
+        digest.update('\0')
+    return 'revisions.diff.' + digest.hexdigest()
+
+def cached_diffs(pairs, fields=None, granularity='word', timeout=TIMEOUT):
+    """
+    Like ``diff_revisions``, but for a list of ``(old, new)`` pairs at once, and
+    with chunks as lists that are kept in Django's cache, for as long as the
+    ``REVISIONS_DIFF_CACHE_TIMEOUT`` setting says (in seconds, defaults to 
+    the cache's default timeout). Takes a single round trip to the cache for
+    everything that's been diffed before.
+    """
+
+    keys = []
+    for old, new in pairs:
+        for name in fields or get_fields(old):
+            values = get_values(old, new, name)
+            if values is not None:
+                keys.append((old, new, name, values, get_cache_key(old, new, name, granularity, values)))
+
+    cached = cache.get_many([key for old, new, name, values, key in keys])
+    missing = {}
+    for old, new, name, values, key in keys:
+        if key not in cached:
+            missing[key] = list(chunks(values[0], values[1], granularity, timeout))
+    if missing:
+        cache.set_many(missing, getattr(settings, 'REVISIONS_DIFF_CACHE_TIMEOUT', None))
+    cached.update(missing)
+
+    changes = dict([((old, new), []) for old, new in pairs])
+    for old, new, name, values, key in keys:
+        changes[(old, new)].append((name, cached[key]))
+    return [changes[(old, new)] for old, new in pairs]
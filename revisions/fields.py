@@ -1,17 +1,142 @@
 # encoding: utf-8
 
-from django.db import models
-
 """
-1. Shouldn't trigger a django.core.management.validation error (which is tricky because it 
-   doesn't check if the field is actually a regular ForeignKey, it just checks if it has a
-   ``rel`` attribute.
-2. Shouldn't add a true FK to databases that support it (that is, anything other than MySQL 
-   and SQLite), but treat the foreign key as a regular integerfield/charfield that just
-   happens to be a reference.
+References to a content bundle rather than to one of its revisions.
+
+A regular ``ForeignKey`` to a versioned model points at a single revision,
+so it goes stale as soon as that content gets revised. ``ForeignKey`` in this
+module stores the bundle id (``cid``) instead, and resolves to the latest
+revision of that bundle::
+
+    class Aside(models.Model):
+        story = revisions.fields.ForeignKey(Story)
+
+    >>> aside.story           # the latest revision, one query
+    >>> aside.story_id        # the bundle id
+    >>> Aside.objects.filter(story=story)
+
+Resolving a reference is a single ``Story.latest.get(cid=...)`` query, which
+uses the pointer table for models that have one (see
+``revisions.latest``.) To resolve references for many objects at once, use
+``select_bundles``, which takes one query per field (per few hundred bundles.)
+
+Django only accepts a ``to_field`` with a unique constraint and would add a
+database-level constraint to it, neither of which makes sense for bundle ids,
+so this field is a plain column that just happens to hold a reference:
+
+1. it doesn't trigger ``django.core.management.validation`` errors (which
+   check anything with a ``rel`` attribute as if it were a regular foreign key)
+2. it doesn't add a foreign key constraint on databases that support them,
+   which also means deleting a bundle won't cascade, and that references to a
+   deleted bundle raise ``DoesNotExist``
+3. for the same reasons, ``QuerySet.select_related`` doesn't follow it
 """
 
-# a pseudo-foreign key that supports referencing either the bundle or the individual revision
-class ForeignKey(models.ForeignKey):
-    def __init__(self):
-        raise NotImplementedError()
\ No newline at end of file
+from django import forms
+from django.db import models, router
+from django.db.models.fields.related import add_lazy_relation
+from revisions import utils
+
+
+class BundleDescriptor(property):
+    # (Model.__init__ only accepts keyword arguments that are fields or properties,
+    # which is why this is a property, so ``Aside(story=story)`` works.)
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        cache_name = self.field.get_cache_name()
+        try:
+            return getattr(instance, cache_name)
+        except AttributeError:
+            cid = getattr(instance, self.field.attname)
+            if cid is None:
+                if self.field.null:
+                    return None
+                raise self.field.to.DoesNotExist
+            db = router.db_for_read(self.field.to, instance=instance)
+            obj = self.field.to.latest.using(db).get(cid=cid)
+            setattr(instance, cache_name, obj)
+            return obj
+
+    def __set__(self, instance, value):
+        if value is None and not self.field.null:
+            raise ValueError('Cannot assign None: "%s.%s" does not allow null values.' %
+                (instance._meta.object_name, self.field.name))
+        elif value is not None and not isinstance(value, (self.field.to, basestring)):
+            raise ValueError('Cannot assign "%r": "%s.%s" must be a "%s" instance or a bundle id.' %
+                (value, instance._meta.object_name, self.field.name, self.field.to._meta.object_name))
+
+        setattr(instance, self.field.attname, self.field.get_prep_value(value))
+        # bundle ids (which is also what deserializers assign) get resolved when needed
+        if isinstance(value, basestring):
+            instance.__dict__.pop(self.field.get_cache_name(), None)
+        else:
+            setattr(instance, self.field.get_cache_name(), value)
+
+
+class ForeignKey(models.CharField):
+    """ A reference to a content bundle, see the module docstring. """
+
+    def __init__(self, to, **kwargs):
+        self.to = to
+        kwargs['max_length'] = 36
+        kwargs.setdefault('db_index', True)
+        super(ForeignKey, self).__init__(**kwargs)
+
+    def get_attname(self):
+        return '%s_id' % self.name
+
+    def get_cache_name(self):
+        return '_%s_cache' % self.name
+
+    def contribute_to_class(self, cls, name):
+        super(ForeignKey, self).contribute_to_class(cls, name)
+        setattr(cls, self.name, BundleDescriptor(self))
+
+        def resolve_related_class(field, model, cls):
+            field.to = model
+        add_lazy_relation(cls, self, self.to, resolve_related_class)
+
+    def get_prep_value(self, value):
+        # we accept revisions as well as bundle ids, both when assigning and in lookups
+        if isinstance(value, models.Model):
+            value = value.cid
+        return super(ForeignKey, self).get_prep_value(value)
+
+    def formfield(self, **kwargs):
+        defaults = {
+            'form_class': forms.ModelChoiceField,
+            'queryset': self.to.latest.all(),
+            'to_field_name': 'cid',
+            }
+        defaults.update(kwargs)
+        # skipping CharField.formfield, which would pass on a max_length
+        return models.Field.formfield(self, **defaults)
+
+    def save_form_data(self, instance, data):
+        setattr(instance, self.name, data)
+
+
+def select_bundles(instances, *names):
+    """ Resolves the bundle references in ``names`` (field names) for a list
+    of model instances, with one query per field per few hundred bundles. """
+
+    if not instances:
+        return
+    for name in names:
+        field = instances[0]._meta.get_field(name)
+        cids = set([getattr(instance, field.attname) for instance in instances])
+        cids.discard(None)
+        db = router.db_for_read(field.to, instance=instances[0])
+        latest = {}
+        for chunk in utils.chunked(cids):
+            for obj in field.to.latest.using(db).filter(cid__in=chunk):
+                latest[obj.cid] = obj
+        for instance in instances:
+            cid = getattr(instance, field.attname)
+            if cid in latest:
+                setattr(instance, field.get_cache_name(), latest[cid])
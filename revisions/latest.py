@@ -0,0 +1,352 @@
+# encoding: utf-8
+
+"""
+Finding the latest revision in each content bundle.
+
+``LatestManager`` restricts its querysets to the latest revision of each
+bundle. There are a couple of ways to do that, each with their own tradeoffs,
+which we call strategies:
+
+* ``subquery``: a correlated ``SELECT MAX(comparator)`` subquery. Works
+  everywhere, but the subquery is evaluated for every single row, which gets
+  expensive on large tables.
+* ``window``: ranks revisions with ``ROW_NUMBER() OVER (PARTITION BY cid ...)``
+  in a single ordered scan. Needs window function support (PostgreSQL,
+  Oracle, SQLite 3.25+).
+* ``distinct_on``: PostgreSQL's ``SELECT DISTINCT ON (cid)``, also a single
+  ordered scan.
+* ``view``: selects from a ``<base_table>_latest_revisions`` view, see below.
+* ``table``: selects from a pointer table, see below.
+
+By default, models with a pointer table use it, ``OPTIMIZE_REVISIONS`` picks
+the view and otherwise we use whatever works best for the database vendor:
+``distinct_on`` on PostgreSQL, ``window`` on Oracle and ``subquery`` elsewhere.
+To force a strategy, e.g. to compare query plans, use a setting::
+
+    REVISIONS_LATEST_STRATEGY = 'subquery'
+
+A forced strategy that isn't available for a model or database is ignored.
+``manage.py benchmark_latest`` shows query plans and timings for each
+strategy that's available.
+
+Models can opt into a real, indexed pointer table::
+
+    class Story(VersionedModel):
+        ...
+
+        class Versioning:
+            latest_table = True
+
+For a model with a base table ``tests_story``, this maintains a table
+``tests_story_latest`` that maps each bundle id (``cid``) to the primary key
+of its latest revision. The pointer table is created and filled after
+``syncdb`` and kept in sync whenever a revision is saved or deleted. Use
+``manage.py rebuild_latest`` to (re)build or verify it for existing data.
+
+Keep in mind that bulk operations that bypass the model (``QuerySet.update``
+on the comparator, raw SQL) won't update the pointer table. Run
+``rebuild_latest`` afterwards.
+
+Alternatively, with ``OPTIMIZE_REVISIONS = True`` in your settings, a
+database view ``<base_table>_latest_revisions`` is created for each versioned
+model after ``syncdb``, and ``LatestManager`` selects from that view instead.
+A view costs nothing on writes, but whether it's faster than the plain
+subquery depends entirely on your database's query planner, so compare the
+query plans on your own data. On databases without view support, the
+setting is ignored.
+"""
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.db.models import AutoField, IntegerField
+from revisions import registry
+
+
+def get_table_for_field(model, field_name):
+    for field in model._meta.fields:
+        if field_name == field.attname:
+            return field.model._meta.db_table
+    return None
+
+
+def uses_latest_table(model):
+    base = registry.get_info(model).base_model
+    return getattr(base.Versioning, 'latest_table', False)
+
+
+def get_latest_table(model):
+    return model.get_base_model()._meta.db_table + '_latest'
+
+
+def _get_names(model, connection):
+    info = registry.get_info(model)
+    qn = connection.ops.quote_name
+    return {
+        'latest_table': qn(get_latest_table(model)),
+        'table': qn(info.base_table),
+        'pk': qn(info.base_model._meta.pk.column),
+        'comparator': qn(info.comparator_column),
+        }
+
+# Selects the latest revision for every bundle (or, with an extra condition
+# on ``rev.cid``, for a single bundle.) In the rare case where two revisions
+# share the same comparator value, the one with the highest primary key wins.
+LATEST_REVISIONS_SQL = \
+    'SELECT rev.cid AS cid, MAX(rev.{pk}) AS {pk} FROM {table} rev ' \
+    'WHERE rev.cid IS NOT NULL{condition} AND rev.{comparator} = ' \
+    '(SELECT MAX(sub.{comparator}) FROM {table} sub WHERE sub.cid = rev.cid) ' \
+    'GROUP BY rev.cid'
+
+def create_latest_table(model, using=DEFAULT_DB_ALIAS):
+    """ Creates the pointer table for a model, unless it already exists. """
+
+    connection = connections[using]
+    table = get_latest_table(model)
+    if table in connection.introspection.table_names():
+        return False
+
+    # a foreign key to an AutoField is a plain integer, not another serial
+    pk = model.get_base_model()._meta.pk
+    if isinstance(pk, AutoField):
+        pk_type = IntegerField().db_type(connection=connection)
+    else:
+        pk_type = pk.db_type(connection=connection)
+
+    names = _get_names(model, connection)
+    cursor = connection.cursor()
+    cursor.execute('CREATE TABLE {latest_table} (cid varchar(36) NOT NULL PRIMARY KEY, {pk} {pk_type} NOT NULL UNIQUE)'.format(
+        pk_type=pk_type, **names))
+    transaction.commit_unless_managed(using=using)
+    return True
+
+def rebuild_latest_table(model, using=DEFAULT_DB_ALIAS):
+    """ Recalculates every pointer from scratch. Returns the amount of bundles. """
+
+    connection = connections[using]
+    names = _get_names(model, connection)
+    cursor = connection.cursor()
+    cursor.execute('DELETE FROM {latest_table}'.format(**names))
+    cursor.execute('INSERT INTO {latest_table} (cid, {pk}) '.format(**names) +
+        LATEST_REVISIONS_SQL.format(condition='', **names))
+    cursor.execute('SELECT COUNT(*) FROM {latest_table}'.format(**names))
+    count = cursor.fetchone()[0]
+    transaction.commit_unless_managed(using=using)
+    return count
+
+def verify_latest_table(model, using=DEFAULT_DB_ALIAS):
+    """ Compares the pointer table to what it should contain, and returns
+    a list of bundle ids whose pointers are missing, stale or wrong. """
+
+    connection = connections[using]
+    names = _get_names(model, connection)
+    cursor = connection.cursor()
+    cursor.execute(LATEST_REVISIONS_SQL.format(condition='', **names))
+    expected = dict(cursor.fetchall())
+    cursor.execute('SELECT cid, {pk} FROM {latest_table}'.format(**names))
+    actual = dict(cursor.fetchall())
+
+    cids = set(expected.keys()) | set(actual.keys())
+    return sorted([cid for cid in cids if expected.get(cid) != actual.get(cid)])
+
+def update_latest_pointers(model, cids, using=DEFAULT_DB_ALIAS):
+    """ Recalculates the pointers for the given bundles. Bundles that no
+    longer have any revisions lose their pointer. """
+
+    cids = [cid for cid in set(cids) if cid]
+    if not cids:
+        return
+
+    connection = connections[using]
+    names = _get_names(model, connection)
+    cursor = connection.cursor()
+    placeholders = ', '.join(['%s'] * len(cids))
+    cursor.execute('DELETE FROM {latest_table} WHERE cid IN ({placeholders})'.format(
+        placeholders=placeholders, **names), cids)
+    condition = ' AND rev.cid IN ({placeholders})'.format(placeholders=placeholders)
+    cursor.execute('INSERT INTO {latest_table} (cid, {pk}) '.format(**names) +
+        LATEST_REVISIONS_SQL.format(condition=condition, **names), cids)
+    transaction.commit_unless_managed(using=using)
+
+# vendors for which we know how to (re)create views
+VIEW_VENDORS = ('postgresql', 'mysql', 'oracle', 'sqlite', )
+
+def supports_views(connection):
+    return connection.vendor in VIEW_VENDORS
+
+def get_latest_view(model):
+    return model.get_base_model()._meta.db_table + '_latest_revisions'
+
+def create_latest_view(model, using=DEFAULT_DB_ALIAS):
+    """ (Re)creates the latest revisions view for a model. Returns False
+    if the database doesn't support views. """
+
+    connection = connections[using]
+    if not supports_views(connection):
+        return False
+
+    names = _get_names(model, connection)
+    view = connection.ops.quote_name(get_latest_view(model))
+    selection = LATEST_REVISIONS_SQL.format(condition='', **names)
+    cursor = connection.cursor()
+    if connection.vendor == 'sqlite':
+        cursor.execute('DROP VIEW IF EXISTS {view}'.format(view=view))
+        cursor.execute('CREATE VIEW {view} AS {selection}'.format(view=view, selection=selection))
+    else:
+        cursor.execute('CREATE OR REPLACE VIEW {view} AS {selection}'.format(view=view, selection=selection))
+    transaction.commit_unless_managed(using=using)
+    return True
+
+
+class Strategy(object):
+    """ A way to restrict a queryset to the latest revision of each bundle. """
+
+    name = None
+
+    def is_available(self, model, connection):
+        return True
+
+    def filter(self, qs):
+        raise NotImplementedError()
+
+
+class SubqueryStrategy(Strategy):
+    name = 'subquery'
+
+    def filter(self, qs):
+        # in case of concrete inheritance, we need the base table, not the leaf
+        info = registry.get_info(qs.model)
+        base_table = info.base_model._meta.db_table
+
+        # this may or may not be the fastest way to get the last revision of every
+        # piece of content, depending on how your database query optimizer works, 
+        # but it sure as hell is the easiest way to do it in Django without resorting
+        # to multiple queries or working entirely with raw SQL.
+        where = '{comparator_table}.{comparator} = (SELECT MAX({comparator}) FROM {table} as sub WHERE {table}.cid = sub.cid)'.format(
+            table=base_table,
+            comparator=info.comparator_column,
+            comparator_table=info.comparator_table)
+        
+        return qs.extra(where=[where])
+
+
+def get_ordering(base):
+    """ Latest revision first. In case of ties, the highest primary key wins. """
+
+    comparator = registry.get_info(base).comparator_column
+    if comparator == base._meta.pk.column:
+        return '{comparator} DESC'.format(comparator=comparator)
+    else:
+        return '{comparator} DESC, {pk} DESC'.format(comparator=comparator, pk=base._meta.pk.column)
+
+
+class WindowStrategy(Strategy):
+    name = 'window'
+
+    def is_available(self, model, connection):
+        if connection.vendor == 'sqlite':
+            from django.db.backends.sqlite3.base import Database
+            return Database.sqlite_version_info >= (3, 25, 0)
+        else:
+            return connection.vendor in ('postgresql', 'oracle', )
+
+    def filter(self, qs):
+        base = registry.get_info(qs.model).base_model
+        where = '{table}.{pk} IN (SELECT {pk} FROM (SELECT {pk}, ROW_NUMBER() OVER ' \
+            '(PARTITION BY cid ORDER BY {ordering}) AS revisions_rank ' \
+            'FROM {table}) ranked WHERE revisions_rank = 1)'.format(
+            table=base._meta.db_table,
+            pk=base._meta.pk.column,
+            ordering=get_ordering(base))
+        return qs.extra(where=[where])
+
+
+class DistinctOnStrategy(Strategy):
+    name = 'distinct_on'
+
+    def is_available(self, model, connection):
+        return connection.vendor == 'postgresql'
+
+    def filter(self, qs):
+        base = registry.get_info(qs.model).base_model
+        where = '{table}.{pk} IN (SELECT DISTINCT ON (cid) {pk} FROM {table} ' \
+            'ORDER BY cid, {ordering})'.format(
+            table=base._meta.db_table,
+            pk=base._meta.pk.column,
+            ordering=get_ordering(base))
+        return qs.extra(where=[where])
+
+
+class ViewStrategy(Strategy):
+    name = 'view'
+
+    def is_available(self, model, connection):
+        return supports_views(connection)
+
+    def filter(self, qs):
+        base = registry.get_info(qs.model).base_model
+        where = '{table}.{pk} IN (SELECT {pk} FROM {latest_view})'.format(
+            table=base._meta.db_table,
+            pk=base._meta.pk.column,
+            latest_view=get_latest_view(base))
+        return qs.extra(where=[where])
+
+
+class TableStrategy(Strategy):
+    name = 'table'
+
+    def is_available(self, model, connection):
+        return uses_latest_table(model)
+
+    def filter(self, qs):
+        base = registry.get_info(qs.model).base_model
+        latest_table = get_latest_table(base)
+        # a subquery rather than a join, because UPDATE and DELETE queries
+        # drop any extra tables
+        where = '{table}.{pk} IN (SELECT {pk} FROM {latest_table})'.format(
+            table=base._meta.db_table,
+            pk=base._meta.pk.column,
+            latest_table=latest_table)
+        return qs.extra(where=[where])
+
+
+STRATEGIES = dict([(strategy.name, strategy) for strategy in (
+    SubqueryStrategy(),
+    WindowStrategy(),
+    DistinctOnStrategy(),
+    ViewStrategy(),
+    TableStrategy(),
+    )])
+
+# What to use when nothing else has been configured. On SQLite, the correlated
+# subquery can use the index on ``cid`` and beats window functions (see 
+# performance.txt), so we only deviate from it where that's known to pay off.
+VENDOR_STRATEGIES = {
+    'postgresql': 'distinct_on',
+    'oracle': 'window',
+    }
+
+def get_available_strategies(model, using=DEFAULT_DB_ALIAS):
+    connection = connections[using]
+    return [strategy for strategy in STRATEGIES.values() if strategy.is_available(model, connection)]
+
+def get_strategy(model, using=DEFAULT_DB_ALIAS):
+    connection = connections[using]
+    candidates = []
+
+    forced = getattr(settings, 'REVISIONS_LATEST_STRATEGY', None)
+    if forced:
+        if forced not in STRATEGIES:
+            raise ImproperlyConfigured("REVISIONS_LATEST_STRATEGY should be one of: %s" % ", ".join(STRATEGIES.keys()))
+        candidates.append(forced)
+    candidates.append('table')
+    if getattr(settings, 'OPTIMIZE_REVISIONS', False):
+        candidates.append('view')
+    if connection.vendor in VENDOR_STRATEGIES:
+        candidates.append(VENDOR_STRATEGIES[connection.vendor])
+    candidates.append('subquery')
+
+    for name in candidates:
+        strategy = STRATEGIES[name]
+        if strategy.is_available(model, connection):
+            return strategy
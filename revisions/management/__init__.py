@@ -0,0 +1,53 @@
+# encoding: utf-8
+
+from django.conf import settings
+from django.db.models import get_models
+from django.db.models.signals import post_syncdb
+from revisions import models as revisions_models
+from revisions import latest, trash
+
+def get_versioned_base_models(app=None):
+    bases = []
+    for model in get_models(app):
+        if issubclass(model, revisions_models.VersionedModelBase):
+            base = model.get_base_model()
+            if base not in bases:
+                bases.append(base)
+    return bases
+
+def get_versioned_models(app=None):
+    return [model for model in get_models(app) 
+        if issubclass(model, revisions_models.VersionedModelBase) and not model._meta.proxy]
+
+def create_latest_tables(sender, created_models, verbosity=1, db='default', **kwargs):
+    for base in get_versioned_base_models(sender):
+        if not latest.uses_latest_table(base):
+            continue
+        created = latest.create_latest_table(base, using=db)
+        if created or base in created_models:
+            if verbosity >= 1 and created:
+                print "Creating table %s" % latest.get_latest_table(base)
+            latest.rebuild_latest_table(base, using=db)
+
+post_syncdb.connect(create_latest_tables, dispatch_uid='revisions.create_latest_tables')
+
+def create_latest_views(sender, verbosity=1, db='default', **kwargs):
+    if not getattr(settings, 'OPTIMIZE_REVISIONS', False):
+        return
+    for base in get_versioned_base_models(sender):
+        if latest.create_latest_view(base, using=db) and verbosity >= 2:
+            print "Creating view %s" % latest.get_latest_view(base)
+
+post_syncdb.connect(create_latest_views, dispatch_uid='revisions.create_latest_views')
+
+def create_trash_indexes(sender, created_models, verbosity=1, db='default', **kwargs):
+    for model in get_versioned_models(sender):
+        if not issubclass(model, revisions_models.TrashableModel) or model not in created_models:
+            continue
+        # once per table, rather than for every subclass that shares it
+        if model._meta.get_field('_is_trash').model is not model:
+            continue
+        if trash.create_trash_index(model, using=db) and verbosity >= 2:
+            print "Creating index %s" % trash.get_trash_index(model)
+
+post_syncdb.connect(create_trash_indexes, dispatch_uid='revisions.create_trash_indexes')
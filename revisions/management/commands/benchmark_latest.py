@@ -0,0 +1,134 @@
+# encoding: utf-8
+
+import time
+import uuid
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.db.models import get_model, AutoField
+from revisions import latest
+from revisions.managers import LatestQuerySet
+
+EXPLAIN = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN ',
+    'mysql': 'EXPLAIN ',
+    }
+
+# generated bundle ids start with this prefix, so we can find them again
+PREFIX = 'benchmark'
+
+class Command(BaseCommand):
+    help = "Shows query plans and timings for each of the strategies LatestManager can use to find the latest revisions of a versioned model."
+    args = 'appname.ModelName'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--bundles', action='store', dest='bundles', type='int', default=0,
+            help='Add this many bundles of test data before benchmarking. Everything is rolled back afterwards.'),
+        make_option('--revisions', action='store', dest='revisions', type='int', default=10,
+            help='The amount of revisions per bundle of test data. Defaults to 10.'),
+        make_option('--repeat', action='store', dest='repeat', type='int', default=3,
+            help='How many times to run each query. Defaults to 3.'),
+        make_option('--database', action='store', dest='database', default=DEFAULT_DB_ALIAS,
+            help='Nominates a database to benchmark. Defaults to the "default" database.'),
+        )
+
+    def handle(self, label=None, **options):
+        if not label:
+            raise CommandError("Please specify a model, e.g. benchmark_latest appname.ModelName")
+        model = get_model(*label.split('.'))
+        if model is None:
+            raise CommandError("Unknown model: %s" % label)
+
+        using = options.get('database')
+        connection = connections[using]
+
+        # (Re)creating the view is harmless, but some databases commit any 
+        # pending changes when they encounter DDL, so we do it first.
+        if latest.supports_views(connection):
+            latest.create_latest_view(model, using=using)
+
+        # Test data is rolled back afterwards. Some database adapters (like 
+        # Python's sqlite3 module) commit whenever they encounter a statement
+        # like EXPLAIN, so we clean up after ourselves as well.
+        transaction.enter_transaction_management(using=using)
+        transaction.managed(True, using=using)
+        try:
+            if options.get('bundles'):
+                self.populate(model, options['bundles'], options['revisions'], using)
+
+            cursor = connection.cursor()
+            cursor.execute('SELECT COUNT(*) FROM %s' % connection.ops.quote_name(model._meta.db_table))
+            print "%s: %i revisions\n" % (model._meta.db_table, cursor.fetchone()[0])
+
+            for strategy in latest.get_available_strategies(model, using=using):
+                self.benchmark(model, strategy, options['repeat'], using)
+        finally:
+            transaction.rollback(using=using)
+            if options.get('bundles'):
+                self.cleanup(model, using)
+                transaction.commit(using=using)
+            transaction.leave_transaction_management(using=using)
+
+    def populate(self, model, bundles, revisions, using):
+        base = model.get_base_model()
+        if model is not base or not isinstance(base._meta.pk, AutoField) \
+            or base.get_comparator_name() != base._meta.pk.attname:
+            raise CommandError("Test data can only be generated for models without concrete "
+                "inheritance, that use an AutoField as their primary key and comparator.")
+
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        fields = [field for field in model._meta.local_fields if not isinstance(field, AutoField)]
+        template = model()
+        values = [field.get_db_prep_save(field.pre_save(template, True), connection=connection) for field in fields]
+        cid_index = [field.attname for field in fields].index('cid')
+        cids = [PREFIX + uuid.uuid4().hex[:36 - len(PREFIX)] for i in range(bundles)]
+
+        sql = 'INSERT INTO {table} ({columns}) VALUES ({placeholders})'.format(
+            table=qn(model._meta.db_table),
+            columns=', '.join([qn(field.column) for field in fields]),
+            placeholders=', '.join(['%s'] * len(fields)))
+        cursor = connection.cursor()
+        # interleave revisions, the way they'd end up in a real table
+        for revision in range(revisions):
+            rows = []
+            for cid in cids:
+                row = list(values)
+                row[cid_index] = cid
+                rows.append(row)
+            cursor.executemany(sql, rows)
+
+        if latest.uses_latest_table(model):
+            latest.rebuild_latest_table(model, using=using)
+
+    def cleanup(self, model, using):
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        tables = [model._meta.db_table]
+        if latest.uses_latest_table(model):
+            tables.append(latest.get_latest_table(model))
+        cursor = connection.cursor()
+        for table in tables:
+            cursor.execute('DELETE FROM {table} WHERE cid LIKE %s'.format(table=qn(table)), [PREFIX + '%'])
+
+    def benchmark(self, model, strategy, repeat, using):
+        connection = connections[using]
+        qs = strategy.filter(LatestQuerySet(model, using=using)).values_list('pk', flat=True)
+        sql, params = qs.query.get_compiler(using=using).as_sql()
+        cursor = connection.cursor()
+
+        print "== %s ==" % strategy.name
+        print sql % tuple(params)
+        if connection.vendor in EXPLAIN:
+            cursor.execute(EXPLAIN[connection.vendor] + sql, params)
+            for row in cursor.fetchall():
+                print "  " + " | ".join([unicode(column) for column in row])
+
+        timings = []
+        for i in range(repeat):
+            start = time.time()
+            cursor.execute(sql, params)
+            rows = len(cursor.fetchall())
+            timings.append(time.time() - start)
+        print "%i rows, best of %i: %.3fs\n" % (rows, repeat, min(timings))
@@ -0,0 +1,53 @@
+# encoding: utf-8
+
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+from revisions import registry
+
+class Command(BaseCommand):
+    help = "Times how long it takes to build querysets for a versioned model and to read versioning metadata " \
+        "off its instances, with the metadata looked up in revisions.registry and with it worked out from scratch " \
+        "every time, which is what used to happen. Doesn't touch the database."
+    args = 'appname.ModelName'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', action='store', dest='repeat', type='int', default=10000,
+            help='How many times to run each operation. Defaults to 10000.'),
+        )
+
+    def handle(self, label=None, **options):
+        if not label:
+            raise CommandError("Please specify a model, e.g. benchmark_querysets appname.ModelName")
+        model = get_model(*label.split('.'))
+        if model is None or registry.get_versioned_model(model._meta.app_label, model._meta.module_name) is None:
+            raise CommandError("Unknown versioned model: %s" % label)
+
+        repeat = options['repeat']
+        instance = model()
+        operations = [
+            ('Model.latest.all()', lambda: model.latest.all()),
+            ('Model.latest.filter(cid=...)', lambda: model.latest.filter(cid='x')),
+            ('instance.comparator', lambda: instance.comparator),
+            ('instance.pk_name', lambda: instance.pk_name),
+            ]
+
+        print "%s, %i runs each, microseconds per run\n" % (label, repeat)
+        print "%-30s %10s %10s" % ('', 'computed', 'registry')
+        for name, operation in operations:
+            print "%-30s %10.1f %10.1f" % (name,
+                self.time(operation, repeat, cached=False),
+                self.time(operation, repeat, cached=True))
+
+    def time(self, operation, repeat, cached):
+        get_info = registry.get_info
+        if not cached:
+            registry.get_info = registry.make_info
+        try:
+            start = time.time()
+            for i in xrange(repeat):
+                operation()
+            return (time.time() - start) / repeat * 1000000
+        finally:
+            registry.get_info = get_info
@@ -0,0 +1,55 @@
+# encoding: utf-8
+
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import get_model
+from revisions import retention
+from revisions.management import get_versioned_models
+
+class Command(BaseCommand):
+    help = "Deletes old revisions according to the retention policy of each versioned model (see Versioning.retention)."
+    args = '[appname.ModelName ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Only report what would be pruned, without deleting anything.'),
+        make_option('--chunk-size', action='store', dest='chunk_size', type='int', default=500,
+            help='How many revisions to delete per transaction. Defaults to 500.'),
+        make_option('--database', action='store', dest='database', default=DEFAULT_DB_ALIAS,
+            help='Nominates a database to prune revisions from. Defaults to the "default" database.'),
+        )
+
+    def handle(self, *labels, **options):
+        using = options.get('database')
+        verbosity = int(options.get('verbosity', 1))
+        dry_run = options.get('dry_run')
+
+        if labels:
+            models = []
+            for label in labels:
+                try:
+                    app_label, model_name = label.split('.')
+                except ValueError:
+                    raise CommandError("Expected a model in the form appname.ModelName, got %s" % label)
+                model = get_model(app_label, model_name)
+                if model is None:
+                    raise CommandError("Unknown model: %s" % label)
+                if not retention.get_policy(model):
+                    raise CommandError("%s does not have a retention policy (see Versioning.retention)" % model.__name__)
+                models.append(model)
+        else:
+            models = [model for model in get_versioned_models() if retention.get_policy(model)]
+
+        totals = [0, 0, 0]
+        for model in models:
+            counts = retention.prune(model, using=using, chunk_size=options.get('chunk_size'), dry_run=dry_run)
+            totals = [total + count for total, count in zip(totals, counts)]
+            if verbosity >= 1:
+                print "%s.%s: %s %i revisions and %i related rows, %i bytes" % (
+                    model._meta.app_label, model.__name__, 
+                    dry_run and "would prune" or "pruned", counts[0], counts[1], counts[2])
+
+        if verbosity >= 1 and len(models) > 1:
+            print "Total: %s %i revisions and %i related rows, %i bytes" % (
+                dry_run and "would prune" or "pruned", totals[0], totals[1], totals[2])
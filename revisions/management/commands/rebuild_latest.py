@@ -0,0 +1,62 @@
+# encoding: utf-8
+
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import get_model
+from revisions import latest
+from revisions.management import get_versioned_base_models
+
+class Command(BaseCommand):
+    help = "Rebuilds (or, with --verify, checks) the latest revision pointer tables of versioned models."
+    args = '[appname.ModelName ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--verify', action='store_true', dest='verify', default=False,
+            help='Only report bundles whose pointer is missing or wrong, without changing anything.'),
+        make_option('--database', action='store', dest='database', default=DEFAULT_DB_ALIAS,
+            help='Nominates a database to rebuild pointer tables for. Defaults to the "default" database.'),
+        )
+
+    def handle(self, *labels, **options):
+        using = options.get('database')
+        verbosity = int(options.get('verbosity', 1))
+
+        if labels:
+            models = []
+            for label in labels:
+                try:
+                    app_label, model_name = label.split('.')
+                except ValueError:
+                    raise CommandError("Expected a model in the form appname.ModelName, got %s" % label)
+                model = get_model(app_label, model_name)
+                if model is None:
+                    raise CommandError("Unknown model: %s" % label)
+                models.append(model.get_base_model())
+        else:
+            models = get_versioned_base_models()
+
+        errors = 0
+        for model in models:
+            if not latest.uses_latest_table(model):
+                if labels:
+                    raise CommandError("%s does not use a latest revision table (see Versioning.latest_table)" % model.__name__)
+                continue
+
+            table = latest.get_latest_table(model)
+            latest.create_latest_table(model, using=using)
+            if options.get('verify'):
+                wrong = latest.verify_latest_table(model, using=using)
+                errors += len(wrong)
+                if verbosity >= 1:
+                    print "%s: %i bundles out of sync" % (table, len(wrong))
+                if verbosity >= 2:
+                    for cid in wrong:
+                        print "  %s" % cid
+            else:
+                count = latest.rebuild_latest_table(model, using=using)
+                if verbosity >= 1:
+                    print "%s: rebuilt pointers for %i bundles" % (table, count)
+
+        if errors:
+            raise CommandError("%i bundles have a missing or wrong latest revision pointer. Run rebuild_latest without --verify to fix them." % errors)
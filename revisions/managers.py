@@ -1,23 +1,277 @@
 # encoding: utf-8
 
 from datetime import datetime
-from django.db import models
-import inspect
+from itertools import groupby
+from django.db import models, router
+from django.db.models.deletion import Collector
+from revisions import latest, storage, utils
+import threading
 
 
-def get_table_for_field(model, field_name):
-    for field in model._meta.fields:
-        if field_name == field.attname:
-            return field.model._meta.db_table
-    return None
+class RawAccess(threading.local):
+    """ While inside a ``with raw_access:`` block, ``LatestManager`` behaves like a
+    plain manager and includes every revision, not just the latest ones. Blocks 
+    can be nested, and each thread keeps track of its own depth. """
+
+    depth = 0
+
+    def __enter__(self):
+        self.depth += 1
+
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+
+raw_access = RawAccess()
 
 
 class LatestQuerySet(models.query.QuerySet):
-    # not too nice performance-wise, but the easiest solution
-    # to make counts play nice with revisions
+    _prefetch_revisions = False
+    _prefetch_related = None
+
+    def _clone(self, *vargs, **kwargs):
+        kwargs.setdefault('_prefetch_revisions', self._prefetch_revisions)
+        kwargs.setdefault('_prefetch_related', self._prefetch_related)
+        return super(LatestQuerySet, self)._clone(*vargs, **kwargs)
+
+    def iterator(self):
+        if not (self._prefetch_revisions or self._prefetch_related):
+            for obj in super(LatestQuerySet, self).iterator():
+                yield obj
+            return
+
+        objs = list(super(LatestQuerySet, self).iterator())
+        if self._prefetch_revisions:
+            prefetch_revisions(objs, using=self.db)
+        if self._prefetch_related:
+            names, distinct = self._prefetch_related
+            prefetch_related(objs, names, distinct=distinct)
+        for obj in objs:
+            yield obj
+
+    def prefetch_revisions(self):
+        """ Fetches every revision of the bundles in this queryset along with
+        it, so that ``get_revisions`` and everything that builds on it (like
+        ``check_if_latest_revision``, ``get_latest_revision`` and the
+        shortcuts) don't need any further queries. """
+        return self._clone(_prefetch_revisions=True)
+
+    def prefetch_related_revisions(self, *names, **kwargs):
+        """ Fetches the objects that ``related_<name>`` would return for every
+        object in this queryset, for each of the related managers in ``names``
+        (e.g. ``'aside_set'``), with a couple of queries per name. Pass
+        ``distinct=True`` to prefetch for ``related_objects(name, distinct=True)``. """
+        return self._clone(_prefetch_related=(names, kwargs.get('distinct', False)))
+
+    # A plain COUNT(*) doesn't play nice with revisions: in case of concrete
+    # inheritance, the base table our latest revision filter refers to only gets
+    # joined in when selecting its columns, which a count doesn't do. Counting
+    # (distinct) bundle ids takes care of that, without fetching any rows.
     def count(self):
-        return len(list(self.iterator()))
-        
+        if self._result_cache is not None and not self._iter:
+            return len(self._result_cache)
+
+        return self.values('cid').distinct().count()
+
+    def exists(self):
+        if self._result_cache is None:
+            return self.values('cid').exists()
+        return bool(self._result_cache)
+
+    def revise(self):
+        """ Creates a new revision for every bundle in this queryset, see
+        ``LatestManager.bulk_revise``. """
+        return self.model.latest.bulk_revise(list(self), using=self.db)
+
+    def _get_cids(self):
+        return list(self.values_list('cid', flat=True).distinct())
+
+    def get_history(self, fields):
+        """ The history of ``fields`` for every bundle in this queryset, as a
+        dictionary of bundle ids and the lists that ``VersionedModelBase.get_history``
+        would return. Takes one query for the bundle ids, and one for the
+        histories of every few hundred bundles. """
+        histories = {}
+        for cids in utils.chunked(self._get_cids()):
+            revisions = self.model.objects.using(self.db).filter(cid__in=cids)
+            histories.update(get_histories(self.model, revisions, fields))
+        return histories
+
+    def delete(self):
+        """ Deletes every bundle in this queryset, rather than just the latest
+        revisions. For trashable models, that means trashing them, just like
+        ``delete`` on a model instance does. """
+        if '_is_trash' in [field.name for field in self.model._meta.fields]:
+            self.trash()
+        else:
+            delete_bundles(self.model, self._get_cids(), self.db)
+    delete.alters_data = True
+
+    def _set_trash(self, is_trash):
+        cids = self._get_cids()
+        with utils.commit_on_success_unless_managed(self.db):
+            for chunk in utils.chunked(cids):
+                self.model.objects.using(self.db).filter(cid__in=chunk).update(_is_trash=is_trash)
+        return len(cids)
+
+    # The following methods only work for models that are both versioned and
+    # trashable. They act on every revision of the bundles in this queryset,
+    # with one query per few hundred bundles, so ``save`` and ``delete`` aren't
+    # called on individual instances.
+
+    def trash(self):
+        """ Moves every bundle in this queryset to the trash, and returns
+        the amount of bundles. """
+        return self._set_trash(True)
+
+    def restore(self):
+        """ Takes every bundle in this queryset out of the trash, and returns
+        the amount of bundles. """
+        return self._set_trash(False)
+
+    def purge(self):
+        """ Permanently deletes every bundle in this queryset, even for
+        trashable models, and returns the amount of bundles. """
+        cids = self._get_cids()
+        delete_bundles(self.model, cids, self.db)
+        return len(cids)
+
+
+class RevisionsQuerySet(models.query.QuerySet):
+    """ All revisions of a content bundle, from oldest to newest, as returned 
+    by ``get_revisions``. The revisions are fetched once and cached on the 
+    instance they were requested from, and ``prev``, ``next`` and ``latest()``
+    are derived from that cached list rather than fetched separately. """
+
+    current = None
+
+    def _clone(self, *vargs, **kwargs):
+        kwargs.setdefault('current', self.current)
+        return super(RevisionsQuerySet, self)._clone(*vargs, **kwargs)
+
+    def _get_revisions(self):
+        if self._result_cache is None:
+            self._result_cache = list(self.iterator())
+        return self._result_cache
+
+    @property
+    def prev(self):
+        older = [revision for revision in self._get_revisions() if revision.comparator < self.current.comparator]
+        if older:
+            return older[-1]
+        else:
+            return None
+
+    @property
+    def next(self):
+        newer = [revision for revision in self._get_revisions() if revision.comparator > self.current.comparator]
+        if newer:
+            return newer[0]
+        else:
+            return None
+
+    def latest(self, field_name=None):
+        if field_name:
+            return super(RevisionsQuerySet, self).latest(field_name)
+
+        revisions = self._get_revisions()
+        if revisions:
+            return revisions[-1]
+        else:
+            raise self.model.DoesNotExist("%s matching query does not exist." % self.model._meta.object_name)
+
+
+def prefetch_revisions(instances, using=None):
+    """ Fills in the revisions cache of model instances (of a single model)
+    with one query per few hundred bundles. """
+
+    instances = [instance for instance in instances if instance.cid]
+    if not instances:
+        return
+    model = instances[0].__class__
+    comparator = model.get_comparator_name()
+    bundles = {}
+    for cids in utils.chunked(set([instance.cid for instance in instances])):
+        revisions = model.objects.using(using or instances[0]._state.db) \
+            .filter(cid__in=cids).order_by('cid', comparator)
+        for cid, bundle in groupby(revisions, lambda revision: revision.cid):
+            bundle = list(bundle)
+            storage.resolve_revisions(bundle)
+            bundles[cid] = bundle
+    for instance in instances:
+        instance._revisions_cache = list(bundles.get(instance.cid, []))
+
+def prefetch_related(instances, names, distinct=False):
+    """ Fills in the related objects cache of model instances (of a single
+    model) for the related managers in ``names``, see ``related_objects``. """
+
+    instances = [instance for instance in instances if instance.cid]
+    if not instances:
+        return
+    cids = set([instance.cid for instance in instances])
+    for name in names:
+        relatedmanager = getattr(instances[0], name)
+        related_model = relatedmanager.model
+        ref_name = utils.get_reference_name(relatedmanager)
+        related = {}
+        objs = {}
+        for chunk in utils.chunked(cids):
+            qs = related_model._default_manager.filter(**{ref_name + '__cid__in': chunk})
+            for pk, cid in qs.values_list('pk', ref_name + '__cid'):
+                pks = related.setdefault(cid, [])
+                if not (distinct and pk in pks):
+                    pks.append(pk)
+            objs.update(related_model._default_manager.in_bulk(set([pk for pks in related.values() for pk in pks]) - set(objs)))
+        key = (related_model, ref_name, distinct)
+        for instance in instances:
+            cache = instance.__dict__.setdefault('_related_cache', {})
+            cache[key] = [objs[pk] for pk in related.get(instance.cid, []) if pk in objs]
+
+def get_histories(model, revisions, fields):
+    """ The values of ``fields`` on a queryset of revisions (which should
+    include every revision of the bundles it covers) as lists of 
+    ``(comparator, pk, value, ...)`` tuples per bundle id, oldest first. """
+
+    fields = list(fields)
+    comparator = model.get_comparator_name()
+    rows = revisions.order_by('cid', comparator).values_list('cid', comparator, 'pk', *fields)
+    histories = {}
+    for cid, bundle in groupby(rows, lambda row: row[0]):
+        histories[cid] = storage.resolve_values(model, [comparator, 'pk'] + fields, [row[1:] for row in bundle])
+    return histories
+
+def delete_bundles(model, cids, using):
+    """ Deletes every revision of these bundles, along with anything that 
+    refers to them, in a single collector run. """
+
+    cids = [cid for cid in cids if cid]
+    if not cids:
+        return
+    with utils.commit_on_success_unless_managed(using):
+        with raw_access:
+            collector = Collector(using=using)
+            for chunk in utils.chunked(cids):
+                revisions = list(model.objects.using(using).filter(cid__in=chunk))
+                # with concrete inheritance, the collector would otherwise
+                # fetch the parent of each revision separately
+                for revision in revisions:
+                    utils.cache_parents(revision)
+                collector.collect(revisions)
+            collector.delete()
+            update_collected_pointers(collector, using)
+
+def update_collected_pointers(collector, using):
+    """ Updates the pointer tables of every versioned model a collector deleted
+    revisions of, including those of cascaded deletes. (Deletes inside 
+    ``raw_access`` leave that to us, see ``revisions.models``.) """
+
+    cids = {}
+    for model, instances in collector.data.items():
+        if hasattr(model, 'Versioning') and latest.uses_latest_table(model):
+            base = model.get_base_model()
+            cids.setdefault(base, set()).update([instance.cid for instance in instances])
+    for base, bundle_cids in cids.items():
+        latest.update_latest_pointers(base, bundle_cids, using=using)
+
 
 class LatestManager(models.Manager):
     """ A manager that returns the latest revision of each bundle of content. """
@@ -25,24 +279,46 @@ class LatestManager(models.Manager):
     @property
     def current(self):
         qs = LatestQuerySet(self.model, using=self._db)
-    
-        # in case of concrete inheritance, we need the base table, not the leaf
-        base = qs.query.model.get_base_model()
-        base_table = base._meta.db_table
-
-        # this may or may not be the fastest way to get the last revision of every
-        # piece of content, depending on how your database query optimizer works, 
-        # but it sure as hell is the easiest way to do it in Django without resorting
-        # to multiple queries or working entirely with raw SQL.
-        comparator_name = base.get_comparator_name()  
-        comparator_table = get_table_for_field(qs.query.model, comparator_name)
-        where = '{comparator_table}.{comparator} = (SELECT MAX({comparator}) FROM {table} as sub WHERE {table}.cid = sub.cid)'.format(
-            table=base_table,
-            comparator=comparator_name,
-            comparator_table=comparator_table)
-        
-        qs = qs.extra(where=[where])
-        return qs
+        # see revisions.latest for the different ways we can find the latest
+        # revision of each bundle, and for how we pick one
+        strategy = latest.get_strategy(self.model, using=self._db or router.db_for_read(self.model))
+        return strategy.filter(qs)
+
+    def bulk_revise(self, instances, using=None):
+        """
+        Revises many model instances at once, and returns the new revisions.
+
+        Uniqueness is validated for all instances together, and new revisions
+        are inserted with a single query per table, and their many-to-many 
+        relations copied with a single query per field. This makes it a lot 
+        faster than calling ``revise`` on each instance, but keep in mind that,
+        just like with ``QuerySet.update``, the ``save`` method isn't called and 
+        no signals are sent. Each bundle can only be revised once per call.
+        """
+
+        instances = list(instances)
+        cids = [instance.cid for instance in instances]
+        if None in cids or len(set(cids)) != len(cids):
+            raise ValueError("Can only revise saved instances, and each bundle only once.")
+
+        using = using or self._db or router.db_for_write(self.model)
+        self.model.validate_bundles(instances)
+        with utils.commit_on_success_unless_managed(using):
+            # the current latest revisions will be stored as deltas or compressed, 
+            # see revisions.storage
+            previous = {}
+            if storage.get_history_fields(self.model):
+                for chunk in utils.chunked(cids):
+                    previous.update([(revision.cid, revision) for revision in self.db_manager(using).filter(cid__in=chunk)])
+
+            revisions = utils.bulk_clone(self.model, instances, using)
+            storage.store_history(self.model, [(previous.get(revision.cid), revision) for revision in revisions], using)
+            if latest.uses_latest_table(self.model):
+                latest.update_latest_pointers(self.model, cids, using=using)
+
+        for instance in instances:
+            instance.clear_revisions_cache()
+        return revisions
 
     def get_query_set(self):              
         # Django uses the default manager (which on versioned models is this one)
@@ -56,9 +332,10 @@ class LatestManager(models.Manager):
         # or a DatabaseError saying "Forced update did not affect any rows."
         #
         # We solve this little issue by simply using the plain models.Manager queryset
-        # when saving. Simple fix, but it does require some trickery with the inspect
-        # module and it does make this module prone to breakage whenever a new Django
-        # version comes out.
+        # when saving or deleting. VersionedModelBase wraps those operations in 
+        # ``raw_access``, which we check here. (Older versions of this app inspected 
+        # the call stack instead, which was both slow and prone to breakage whenever
+        # a new Django version came out.)
         #
         # revisions.tests.AppTests.test_update_old_revision_in_place tests whether this works.
         #
@@ -67,13 +344,7 @@ class LatestManager(models.Manager):
         # ... but we feel that versioning should be an absolutely transparant concern, 
         # and work on related resources and in the admin without any fuss, leading us
         # to waive this concern.
-   
-        stack = inspect.stack()[3][3]
-        # * 'save' for saving for plain models
-        # * 'save_base' for saving models with inheritance
-        # * '_collect_sub_objects' for deleting models with inheritance (Django 1.2)
-        # * 'collect' for deleting models with inheritance (Django 1.3)
-        if stack.startswith('save') or stack == 'collect' or stack == '_collect_sub_objects':
+        if raw_access.depth:
             return super(LatestManager, self).get_query_set()
         else:
             return self.current
@@ -83,4 +354,9 @@ def trash_aware(cls):
     for manager in cls._meta.abstract_managers:
         manager[2].trash = manager[2].filter(_is_trash=True)
         manager[2].live = manager[2].filter(_is_trash=False)
+    # Filtering makes Django cache which models refer to this one, but models
+    # defined further down (e.g. subclasses) aren't known yet. Deletes that
+    # cascade rely on that cache, so we throw it away again.
+    for cache in ('_related_objects_cache', '_related_many_to_many_cache', '_name_map'):
+        cls._meta.__dict__.pop(cache, None)
     return cls
\ No newline at end of file
@@ -6,8 +6,7 @@ from django.http import Http404
 from django.conf import settings
 from django.core.urlresolvers import resolve, reverse, Resolver404
 from django.shortcuts import redirect
-from django.contrib.contenttypes.models import ContentType
-from revisions.models import VersionedModel
+from revisions import registry
 
 class VersionedModelRedirectMiddleware(object):
     def process_response(self, request, response):
@@ -20,10 +19,10 @@ class VersionedModelRedirectMiddleware(object):
             if route[0].__name__  == 'change_view':
                 # 1. figure out which model instance the request was for
                 app, model, pk = request.path_info.rstrip('/').split('/')[-3:]
-                cls = ContentType.objects.get(app_label=app, model=model).model_class()
+                cls = registry.get_versioned_model(app, model)
                 
                 # 2. get the latest revision for that content
-                if issubclass(cls, VersionedModel):
+                if cls is not None:
                     obj = cls.objects.get(pk=pk).get_latest_revision()
                     # 3. redirect
                     return redirect(reverse('admin:%s_%s_change' % (app, model), args=[obj.pk]))
@@ -1,15 +1,17 @@
 # encoding: utf-8
 
 import uuid
-import difflib
+import operator
 from datetime import date
 from django.db import models
 from django.utils.translation import ugettext as _
+from django.utils.safestring import mark_safe
+from django.utils.html import escape
 from django.core.exceptions import ImproperlyConfigured, ValidationError
-from django.db import IntegrityError
-from django.contrib.contenttypes.models import ContentType
-from revisions import managers, utils
-import inspect
+from django.db import IntegrityError, router
+from django.db.models.deletion import Collector
+from django.db.models.signals import post_save, pre_delete, post_delete, class_prepared
+from revisions import managers, utils, latest, storage, diff, registry, accessors
 
 # the crux of all errors seems to be that, with VersionedBaseModel, 
 # doing setattr(self, self.pk_name, None) does _not_ lead to creating
@@ -22,12 +24,15 @@ import inspect
 # ``vid``.
 
 class VersionedModelBase(models.Model, utils.ClonableMixin):
+    @classmethod
+    def get_versioning(cls):
+        """ What we need to know about this model to version it, worked out
+        once per class. See ``revisions.registry``. """
+        return registry.get_info(cls)
+
     @classmethod
     def get_base_model(cls):
-        base = cls
-        while isinstance(base._meta.pk, models.OneToOneField):
-            base = base._meta.pk.rel.to
-        return base    
+        return registry.get_info(cls).base_model
 
     @property
     def base_model(self):
@@ -35,40 +40,33 @@ class VersionedModelBase(models.Model, utils.ClonableMixin):
 
     @property
     def pk_name(self):
-        return self.base_model._meta.pk.attname
+        return registry.get_info(self.__class__).pk_name
 
     # For UUIDs in particular, we need a way to know the order of revisions
     # e.g. through a ``changed`` datetime field.
     @classmethod
     def get_comparator_name(cls):
-        if hasattr(cls.Versioning, 'comparator'):
-            return cls.Versioning.comparator
-        else:
-            return cls.get_base_model()._meta.pk.attname
+        return registry.get_info(cls).comparator_name
 
     @property
     def comparator_name(self):
-        return self.get_comparator_name()
+        return registry.get_info(self.__class__).comparator_name
 
     @property
     def comparator(self):
-        return getattr(self, self.comparator_name)
+        return getattr(self, registry.get_info(self.__class__).comparator_name)
 
     @classmethod
     def get_implementations(cls):
-        models = [contenttype.model_class() for contenttype in ContentType.objects.all()]
-        return [model for model in models if isinstance(model, cls)]
+        return registry.get_implementations(cls)
 
     @property
     def _base_model(self):
-        base = self
-        while isinstance(base._meta.pk, models.OneToOneField):
-            base = base._meta.pk.rel.to
-        return base    
+        return registry.get_info(self.__class__).base_model
 
     @property
     def _base_table(self):
-        return self._base_model._meta.db_table
+        return registry.get_info(self.__class__).base_table
 
     # content bundle id
     cid = models.CharField(max_length=36, editable=False, null=True, db_index=True)
@@ -80,20 +78,24 @@ class VersionedModelBase(models.Model, utils.ClonableMixin):
     # all related revisions, plus easy shortcuts to the previous and next revision
     def get_revisions(self):
         qs = self.__class__.objects.filter(cid=self.cid).order_by(self.comparator_name)
-        
-        try:
-            qs.prev = qs.filter(**{self.comparator_name + '__lt': self.comparator}).order_by('-' + self.comparator_name)[0]
-        except IndexError:
-            qs.prev = None
-        try:
-            qs.next = qs.filter(**{self.comparator_name + '__gt': self.comparator})[0]
-        except IndexError:
-            qs.next = None
-        
+        qs = qs._clone(klass=managers.RevisionsQuerySet, current=self)
+
+        if '_revisions_cache' not in self.__dict__:
+            self._revisions_cache = list(qs.iterator())
+            storage.resolve_revisions(self._revisions_cache)
+        qs._result_cache = list(self._revisions_cache)
         return qs
+
+    def clear_revisions_cache(self):
+        self.__dict__.pop('_revisions_cache', None)
     
     def check_if_latest_revision(self):
-        return self.comparator >= max([version.comparator for version in self.get_revisions()])
+        # no need to hit the database if we've already fetched the bundle
+        if '_revisions_cache' in self.__dict__:
+            return self.comparator >= max([version.comparator for version in self._revisions_cache])
+
+        newer = self.__class__.objects.filter(cid=self.cid, **{self.comparator_name + '__gt': self.comparator})
+        return not newer.exists()
     
     @classmethod
     def fetch(cls, criterion):
@@ -117,23 +119,41 @@ class VersionedModelBase(models.Model, utils.ClonableMixin):
     
         # You can only revert a model instance back to a previous instance.
         # Not any ol' object will do, and we check for that.
-        if revert_to_obj.pk not in self.get_revisions().values_list('pk', flat=True):
+        if revert_to_obj.pk not in [revision.pk for revision in self.get_revisions()]:
             raise IndexError("Cannot revert to a primary key that is not part of the content bundle.")
         else:
+            self.clear_revisions_cache()
             return revert_to_obj.revise()
             
     def get_latest_revision(self):
-        return self.get_revisions().order_by('-' + self.comparator)[0]
+        return self.get_revisions().latest()
     
     def make_current_revision(self):
         if not self.check_if_latest_revision():
             self.save()
 
-    def show_diff_to(self, to, field):
-        frm = unicode(getattr(self, field)).split()
-        to = unicode(getattr(to, field)).split()
-        differ = difflib.HtmlDiff()
-        return differ.make_table(frm, to)
+    def show_diff_to(self, to, field, granularity='word'):
+        """ The changes to a field between this revision and another one, 
+        as HTML, with ``<del>`` and ``<ins>`` tags. """
+        changes = diff.cached_diffs([(self, to)], [field], granularity)[0]
+        if changes:
+            return mark_safe(u''.join(diff.render_html(changes[0][1])))
+        else:
+            return escape(unicode(getattr(self, field)))
+
+    def diff_to(self, to, fields=None, granularity='word'):
+        """ The changes between this revision and another one, for every field
+        (or just ``fields``), see ``revisions.diff.cached_diffs``. """
+        return diff.cached_diffs([(self, to)], fields, granularity)[0]
+
+    def get_revision_diffs(self, fields=None, granularity='word'):
+        """ The changes between each revision in this bundle and the one before it, 
+        as a list of ``(older, newer, changes)`` tuples, oldest first. Diffs are 
+        cached, so this only computes diffs for revisions that are new. """
+        revisions = list(self.get_revisions())
+        pairs = zip(revisions[:-1], revisions[1:])
+        changes = diff.cached_diffs(pairs, fields, granularity)
+        return [(older, newer, diffs) for (older, newer), diffs in zip(pairs, changes)]
 
     def _get_unique_checks(self, exclude=[]):
         # for parity with Django's unique_together notation shortcut
@@ -155,58 +175,43 @@ class VersionedModelBase(models.Model, utils.ClonableMixin):
         model._meta.unique_together = unique_together
         return models.Model._get_unique_checks(model, exclude)          
 
+    def get_history(self, fields):
+        """ The values of ``fields`` on every revision of this content bundle,
+        as ``(comparator, pk, value, ...)`` tuples, from oldest to newest. 
+        Unlike ``get_revisions``, this only fetches the columns you ask for. """
+        revisions = self.__class__.objects.using(self._state.db).filter(cid=self.cid)
+        return managers.get_histories(self.__class__, revisions, fields).get(self.cid, [])
+
     def _get_attribute_history(self, name):
-        if self.__dict__.get(name, False):
-            return [(version.__dict__[name], version) for version in self.get_revisions()]
+        if name in [field.attname for field in self._meta.fields]:
+            return [(value, pk) for comparator, pk, value in self.get_history([name])]
         else:
             raise AttributeError(name)
 
-    def _get_related_objects(self, relatedmanager):
+    def _get_related_objects(self, relatedmanager, distinct=False):
         """ This method extends a regular related-manager by also including objects
         that are related to other versions of the same content, instead of just to
-        this one object. """
+        this one object. Objects related to more than one revision (e.g. through a 
+        many-to-many relation, which gets copied to each new revision) are included
+        once for each of them, unless you ask for distinct results. """
         
         related_model = relatedmanager.model
-        related_model_name = related_model._meta.module_name
-        
-        # The foreign key field name on related objects often, by convention,
-        # coincides with the name of the class it relates to, but not always, 
-        # e.g. you could do something like
-        #   class Book(models.Model):
-        #       thingmabob = models.ForeignKey(Author)
-        #
-        # There is, afaik, no elegant way to get a RelatedManager to tell us that
-        # related objects refer to this class by 'thingmabob', leading to this
-        # kind of convoluted deep dive into the internals of the related class.
-        #
-        # By all means, I'd welcome suggestions for prettier code.
-        ref_name = self._meta._name_map[related_model_name][0].field.name
-        pks = [story.pk for story in self.get_revisions()]        
-        objs = related_model._default_manager.filter(**{ref_name + '__in': pks})
-        
+        ref_name = utils.get_reference_name(relatedmanager)
+        objs = related_model._default_manager.filter(**{ref_name + '__cid': self.cid})
+        if distinct:
+            objs = objs.distinct()
+
+        # see managers.prefetch_related
+        cache = self.__dict__.get('_related_cache', {})
+        key = (related_model, ref_name, distinct)
+        if key in cache:
+            objs._result_cache = list(cache[key])
         return objs
+
+    def related_objects(self, name, distinct=False):
+        """ Like ``related_<name>``, e.g. ``story.related_objects('aside_set')``. """
+        return self._get_related_objects(getattr(self, name), distinct=distinct)
     
-    def __getattr__(self, name):
-        # we catch all lookups that start with 'related_'
-        if name.startswith('related_'):
-            related_name = "_".join(name.split("_")[1:])
-            attribute = getattr(self, related_name, False)
-            # we piggyback off of an existing relationship,
-            # so the attribute has to exist and it has to be a 
-            # RelatedManager or ManyRelatedManager
-            if attribute:
-                # (we check the module instead of using isinstance, since 
-                # ManyRelatedManager is created using a factory so doesn't
-                # actually exist inside of the module)
-                if attribute.__class__.__dict__['__module__'] == 'django.db.models.fields.related':
-                    return self._get_related_objects(attribute)
-
-        if name.endswith('_history'):
-            attribute = name.replace('_history', '')
-            return self._get_attribute_history(attribute)
-
-        raise AttributeError(name)
-            
     def prepare_for_writing(self):
         """
         This method allows you to clear out certain fields in the model that are
@@ -225,8 +230,44 @@ class VersionedModelBase(models.Model, utils.ClonableMixin):
             except ValidationError, error:
                 raise IntegrityError(error)
 
+    @classmethod
+    def validate_bundles(cls, instances):
+        """ The equivalent of calling ``validate_bundle`` on each instance, 
+        but with one query per uniqueness constraint rather than per instance. 
+        Also makes sure no two instances would end up clashing with each other. """
+
+        if not instances:
+            return
+        if not (getattr(cls.Versioning, 'unique_together', None) or getattr(cls.Versioning, 'unique', None)):
+            return
+
+        unique_checks, date_checks = instances[0]._get_unique_checks()
+        for model_class, unique_check in set(unique_checks):
+            fields = [cls._meta.get_field(name) for name in unique_check]
+            if [field for field in fields if field.primary_key]:
+                continue
+
+            # just like Django, we skip instances that lack a value for any of the fields
+            values = {}
+            for instance in instances:
+                value = tuple([getattr(instance, field.attname) for field in fields])
+                if None in value:
+                    continue
+                if value in values:
+                    raise IntegrityError(instance.unique_error_message(model_class, unique_check))
+                values[value] = instance
+
+            for chunk in utils.chunked(values.keys(), 100):
+                lookups = [models.Q(**dict(zip(unique_check, value))) for value in chunk]
+                qs = model_class._default_manager.filter(reduce(operator.or_, lookups))
+                for row in qs.values_list('cid', *unique_check):
+                    instance = values.get(tuple(row[1:]))
+                    if instance and instance.cid != row[0]:
+                        raise IntegrityError(instance.unique_error_message(model_class, unique_check))
+
     def revise(self):
         self.validate_bundle()
+        self.clear_revisions_cache()
         return self.clone()
 
     def save(self, *vargs, **kwargs):       
@@ -241,14 +282,52 @@ class VersionedModelBase(models.Model, utils.ClonableMixin):
             self.cid = uuid.uuid4().hex
 
         self.validate_bundle()
-        super(VersionedModelBase, self).save(*vargs, **kwargs)
+        # the new revision and the pointer to it are committed together, or not at all
+        using = kwargs.get('using') or router.db_for_write(self.__class__, instance=self)
+        with utils.commit_on_success_unless_managed(using):
+            # see revisions.storage: the revision before this one gets stored as a 
+            # (compressed) delta against this one, or in full if it no longer precedes it
+            previous = storage.get_previous(self, using=kwargs.get('using'))
+            adding = self.pk is None or self._state.adding
+            comparator = self.comparator
+            super(VersionedModelBase, self).save(*vargs, **kwargs)
+            if previous is not None:
+                if adding or self.comparator == comparator:
+                    storage.store_history(self.__class__, [(previous, self)], using=self._state.db)
+                else:
+                    storage.store_full(self.__class__, [previous], using=self._state.db)
+            self.update_latest_pointer()
+        self.clear_revisions_cache()
+
+    def save_base(self, *vargs, **kwargs):
+        with managers.raw_access:
+            super(VersionedModelBase, self).save_base(*vargs, **kwargs)
+
+    def update_latest_pointer(self, using=None):
+        if latest.uses_latest_table(self.__class__):
+            latest.update_latest_pointers(self.__class__, [self.cid], using=using or self._state.db)
         
     def delete_revision(self, *vargs, **kwargs):
-        super(VersionedModelBase, self).delete(*vargs, **kwargs)
+        using = self._state.db
+        with utils.commit_on_success_unless_managed(using):
+            previous = storage.get_previous(self, using=using)
+            with managers.raw_access:
+                collector = Collector(using=using)
+                collector.collect([self])
+                collector.delete()
+            storage.store_full(self.__class__, [previous], using=using)
+            managers.update_collected_pointers(collector, using)
+        self.clear_revisions_cache()
     
     def delete(self, *vargs, **kwargs):
-        for revision in self.get_revisions():
-            revision.delete_revision(*vargs, **kwargs)
+        # trashable models come after us in the method resolution order, 
+        # but trashing a bundle shouldn't go through it revision by revision
+        if isinstance(self, TrashableModel):
+            return TrashableModel.delete(self)
+
+        # all revisions at once, see ``managers.delete_bundles``
+        managers.delete_bundles(self.__class__, [self.cid], using=kwargs.get('using') or self._state.db)
+        self.clear_revisions_cache()
 
     class Meta:
         abstract = True
@@ -257,6 +336,7 @@ class VersionedModelBase(models.Model, utils.ClonableMixin):
         clear_each_revision = []
         publication_date = None
         unique_together = ()
+        latest_table = False
 
 class VersionedModel(VersionedModelBase):
     vid = models.AutoField(primary_key=True)
@@ -264,6 +344,33 @@ class VersionedModel(VersionedModelBase):
     class Meta:
         abstract = True
 
+# Fixtures are loaded using ``save_base(raw=True)``, which bypasses our own
+# save method, so we keep pointer tables in sync through the signal instead.
+def update_latest_pointer_on_raw_save(sender, instance, raw, **kwargs):
+    if raw and isinstance(instance, VersionedModelBase) and instance.cid:
+        instance.update_latest_pointer()
+
+post_save.connect(update_latest_pointer_on_raw_save, dispatch_uid='revisions.latest_pointer')
+
+# Our own deletes update pointer tables once they're done, but deleting through a 
+# plain manager or a cascade from another model only tells us through the signal.
+def update_latest_pointer_on_delete(sender, instance, **kwargs):
+    if not managers.raw_access.depth and isinstance(instance, VersionedModelBase) and instance.cid:
+        instance.update_latest_pointer(using=kwargs.get('using'))
+
+post_delete.connect(update_latest_pointer_on_delete, dispatch_uid='revisions.latest_pointer_delete')
+
+# The revision before a deleted one may be stored as a delta against it (see
+# revisions.storage), so we store it in full while we can still reconstruct it.
+# Again, our own deletes take care of this themselves.
+def store_previous_on_delete(sender, instance, using, **kwargs):
+    if not managers.raw_access.depth and isinstance(instance, VersionedModelBase) and instance.cid:
+        storage.store_full(sender, [storage.get_previous(instance, using=using)], using=using)
+
+pre_delete.connect(store_previous_on_delete, dispatch_uid='revisions.storage_delete')
+class_prepared.connect(storage.install_descriptors, dispatch_uid='revisions.storage')
+class_prepared.connect(accessors.install_accessors, dispatch_uid='revisions.accessors')
+
 class TrashableModel(models.Model):
     """ Users wanting a version history may also expect a trash bin
     that allows them to recover deleted content, as is e.g. the
@@ -274,25 +381,55 @@ class TrashableModel(models.Model):
     @property
     def is_trash(self):
         return self._is_trash
+
+    @classmethod
+    def get_implementations(cls):
+        return registry.get_implementations(cls)
     
     def get_content_bundle(self):
         if isinstance(self, VersionedModelBase):
             return self.get_revisions()
         else:
             return [self]        
-    
+
+    def _get_bundle_queryset(self):
+        if isinstance(self, VersionedModelBase):
+            return self.__class__.objects.using(self._state.db).filter(cid=self.cid)
+        else:
+            return self.__class__._base_manager.using(self._state.db).filter(pk=self.pk)
+
+    def _set_trash(self, is_trash):
+        # a single UPDATE for every revision in the bundle, rather than
+        # validating and saving them one by one
+        self._get_bundle_queryset().update(_is_trash=is_trash)
+        self._is_trash = is_trash
+        if isinstance(self, VersionedModelBase):
+            self.clear_revisions_cache()
+
     def delete(self):
         """
         It makes no sense to trash individual revisions: either you keep a version history or you don't.
         If you want to undo a revision, you should use obj.revert_to(preferred_revision) instead.
         """
-        for obj in self.get_content_bundle():
-            obj._is_trash = True
-            obj.save()
+        self._set_trash(True)
+
+    def restore(self):
+        """ Takes this object, or its content bundle, out of the trash. """
+        self._set_trash(False)
     
     def delete_permanently(self):    
-        for obj in self.get_content_bundle():
-            super(TrashableModel, obj).delete()
+        if isinstance(self, VersionedModelBase):
+            managers.delete_bundles(self.__class__, [self.cid], using=self._state.db)
+            self.clear_revisions_cache()
+        else:
+            super(TrashableModel, self).delete()
     
     class Meta:
-        abstract = True
\ No newline at end of file
+        abstract = True
+
+def register_model(sender, **kwargs):
+    versioned = issubclass(sender, VersionedModelBase)
+    if versioned or issubclass(sender, TrashableModel):
+        registry.register(sender, versioned=versioned)
+
+class_prepared.connect(register_model, dispatch_uid='revisions.registry')
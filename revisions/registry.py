@@ -0,0 +1,100 @@
+# encoding: utf-8
+
+"""
+Which models are versioned or trashable.
+
+Every concrete subclass of ``VersionedModelBase`` or ``TrashableModel`` is
+registered when Django prepares the class (see the ``class_prepared`` handler
+at the bottom of ``revisions.models``), so finding out which models are
+versioned never involves looking through content types or installed apps.
+
+For versioned models, the registry also holds a ``VersioningInfo``: what we 
+need to know about a model on every query and for every revision, worked out
+once per class rather than by walking ``_meta`` each time:
+
+* ``base_model`` and ``base_table``: with concrete inheritance, the model and
+  table where the bundle id and primary key live
+* ``pk_name``: the attribute name of the primary key of the base model
+* ``comparator_name``, ``comparator_table`` and ``comparator_column``: which
+  field orders the revisions in a bundle, and where it's stored (the column
+  is what the raw SQL in ``revisions.latest`` orders and compares on)
+* ``clone_fields``: the attributes that are copied to a new revision
+"""
+
+from collections import namedtuple
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models.loading import app_cache_ready, get_model
+from django.utils.datastructures import SortedDict
+from revisions import utils
+
+VersioningInfo = namedtuple('VersioningInfo', 'base_model base_table pk_name '
+    'comparator_name comparator_table comparator_column clone_fields')
+
+# model -> VersioningInfo, or None for trashable models that aren't versioned
+_models = SortedDict()
+# base class -> models that subclass it, cached once the app cache is complete
+_implementations = {}
+
+
+def make_info(model):
+    base = utils.get_concrete_models(model)[0]
+    comparator_name = getattr(model.Versioning, 'comparator', base._meta.pk.attname)
+    for field in model._meta.fields:
+        if field.attname == comparator_name:
+            comparator = field
+            break
+    else:
+        raise ImproperlyConfigured("%s.Versioning.comparator should be the attribute name of "
+            "one of its fields." % model.__name__)
+    # everything except for the primary key, the comparator and creation dates
+    clone_fields = tuple([field.attname for field in model._meta.fields if not 
+        (field.primary_key or field.name == comparator_name or utils.is_creation_date(field))])
+    return VersioningInfo(
+        base_model=base,
+        base_table=base._meta.db_table,
+        pk_name=base._meta.pk.attname,
+        comparator_name=comparator_name,
+        comparator_table=comparator.model._meta.db_table,
+        comparator_column=comparator.column,
+        clone_fields=clone_fields,
+        )
+
+def register(model, versioned=True):
+    if versioned:
+        _models[model] = make_info(model)
+    else:
+        _models[model] = None
+    _implementations.clear()
+
+def get_info(model):
+    """ The ``VersioningInfo`` for a versioned model. """
+    try:
+        info = _models[model]
+    except KeyError:
+        info = None
+    if info is None:
+        info = make_info(model)
+        _models[model] = info
+    return info
+
+def is_installed(model):
+    return get_model(model._meta.app_label, model._meta.object_name) is model
+
+def get_implementations(base):
+    """ Every installed concrete (non-proxy) model that subclasses ``base``. """
+
+    if base in _implementations:
+        return _implementations[base]
+    implementations = [model for model in _models.keys() if issubclass(model, base)
+        and not model._meta.proxy and is_installed(model)]
+    if app_cache_ready():
+        _implementations[base] = implementations
+    return implementations
+
+def get_versioned_model(app_label, model_name):
+    """ Looks up a versioned model by app label and (lowercase) model name. """
+    for model, info in _models.items():
+        if info is not None and model._meta.app_label == app_label \
+            and model._meta.module_name == model_name and is_installed(model):
+            return model
+    return None
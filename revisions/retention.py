@@ -0,0 +1,275 @@
+# encoding: utf-8
+
+"""
+Pruning old revisions.
+
+Bundles grow with every revision. Models can bound that growth with a
+retention policy::
+
+    class Story(VersionedModel):
+        ...
+        changed = models.DateTimeField(auto_now=True)
+
+        class Versioning:
+            publication_date = 'published'
+            retention = {
+                # always keep the 10 most recent revisions of a bundle
+                'keep_last': 10,
+                # revisions that are more than 30 days old are thinned out
+                # to the most recent revision of each day
+                'daily_after': 30,
+                # never prune revisions with a publication date in the past
+                'keep_published': True,
+                # when revisions were made, defaults to the comparator
+                'date_field': 'changed',
+                }
+
+The latest revision of a bundle is never pruned, and neither is any revision
+that's still referenced by other objects (e.g. through a foreign key), as
+deleting those would either fail or take the referencing objects with it.
+A revision is pruned when none of the rules say it should be kept, so
+a policy with only ``keep_last`` keeps just that many revisions.
+
+``manage.py prune_revisions`` applies these policies. It deletes revisions in
+chunks, each in its own transaction (unless you call it inside one), straight
+from every table in the inheritance chain, together with their many-to-many
+relations.
+"""
+
+from datetime import datetime, time, timedelta
+from itertools import groupby
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, models
+from revisions import storage, utils
+
+
+def get_policy(model):
+    return getattr(model.Versioning, 'retention', None)
+
+def get_date_field(model, policy):
+    name = policy.get('date_field', model.get_comparator_name())
+    field = model._meta.get_field(name)
+    if not isinstance(field, models.DateField):
+        raise ImproperlyConfigured("%s.Versioning.retention has a 'daily_after' rule, which needs "
+            "a 'date_field' that refers to a date or datetime field." % model.__name__)
+    return name
+
+def as_datetime(value):
+    if isinstance(value, datetime):
+        return value
+    else:
+        return datetime.combine(value, time())
+
+def get_day(value):
+    if isinstance(value, datetime):
+        return value.date()
+    else:
+        return value
+
+def select_prunable(policy, revisions, now):
+    """
+    Applies a retention policy to the revisions of a single bundle, given as
+    ``(pk, date, publication date)`` tuples from newest to oldest, and
+    returns the primary keys of the revisions that can go.
+    """
+
+    keep_last = policy.get('keep_last', 0)
+    daily_after = policy.get('daily_after', None)
+    keep_published = policy.get('keep_published', False)
+    if daily_after is not None:
+        cutoff = now - timedelta(days=daily_after)
+
+    prunable = []
+    days = set()
+    for i, (pk, revision_date, publication_date) in enumerate(revisions):
+        if i == 0 or i < keep_last:
+            keep = True
+        elif keep_published and publication_date is not None and as_datetime(publication_date) <= now:
+            keep = True
+        elif daily_after is not None:
+            # keep recent revisions, and the most recent one of each day before that
+            keep = revision_date is None or as_datetime(revision_date) >= cutoff \
+                or get_day(revision_date) not in days
+        else:
+            keep = False
+
+        if daily_after is not None and revision_date is not None:
+            days.add(get_day(revision_date))
+        if not keep:
+            prunable.append(pk)
+    return prunable
+
+def get_references(model):
+    """ Relations from other models to any of the tables this model is stored in,
+    except for the ones we'll delete ourselves: parent links within the inheritance
+    chain and the intermediary tables of its many-to-many fields. """
+
+    chain = utils.get_concrete_models(model)
+    throughs = [field.rel.through for field in model._meta.many_to_many]
+    references = []
+    for level in chain:
+        for related in level._meta.get_all_related_objects(local_only=True, include_hidden=True):
+            if related.model in chain or related.model in throughs:
+                continue
+            # references to a bundle rather than to a specific revision don't count
+            if related.field.rel.get_related_field() != level._meta.pk:
+                continue
+            references.append((related.model, related.field))
+        for related in level._meta.get_all_related_many_to_many_objects():
+            references.append((related.field.rel.through, None))
+    return references
+
+def exclude_referenced(model, pks, using):
+    pks = set(pks)
+    for related_model, field in get_references(model):
+        if field is None:
+            # the intermediary table of a many-to-many field on another model
+            through = related_model._meta
+            fields = [f for f in through.fields if isinstance(f, models.ForeignKey) and issubclass(model, f.rel.to)]
+        else:
+            fields = [field]
+        for field in fields:
+            referenced = related_model._base_manager.using(using) \
+                .filter(**{field.name + '__in': list(pks)}).values_list(field.name, flat=True)
+            pks.difference_update(referenced)
+    return pks
+
+# how to get the length of text in bytes rather than characters, on vendors
+# where the standard OCTET_LENGTH doesn't work
+OCTET_LENGTHS = {
+    'sqlite': 'LENGTH(CAST({column} AS BLOB))',
+    'oracle': 'LENGTHB({column})',
+    }
+
+def measure(model, pks, using):
+    """ The amount of text stored in these revisions, in bytes, which is the
+    bulk of what we'll reclaim. """
+
+    connection = connections[using]
+    octet_length = OCTET_LENGTHS.get(connection.vendor, 'OCTET_LENGTH({column})')
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    total = 0
+    for level in utils.get_concrete_models(model):
+        columns = [field.column for field in level._meta.local_fields
+            if field.get_internal_type() in ('CharField', 'TextField', 'SlugField')]
+        if not columns:
+            continue
+        sql = 'SELECT {sums} FROM {table} WHERE {pk} IN ({placeholders})'.format(
+            sums=' + '.join(['COALESCE(SUM(%s), 0)' % octet_length.format(column=qn(column)) for column in columns]),
+            table=qn(level._meta.db_table),
+            pk=qn(level._meta.pk.column),
+            placeholders=', '.join(['%s'] * len(pks)))
+        cursor.execute(sql, list(pks))
+        total += cursor.fetchone()[0] or 0
+    return total
+
+def count_related(model, pks, using):
+    """ The amount of many-to-many relations these revisions have. """
+
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    total = 0
+    for field in model._meta.many_to_many:
+        cursor.execute('SELECT COUNT(*) FROM {table} WHERE {column} IN ({placeholders})'.format(
+            table=qn(field.rel.through._meta.db_table),
+            column=qn(field.m2m_column_name()),
+            placeholders=', '.join(['%s'] * len(pks))), list(pks))
+        total += cursor.fetchone()[0]
+    return total
+
+def delete(model, pks, using):
+    """ Deletes revisions from every table they're stored in, and their 
+    many-to-many relations. """
+
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    placeholders = ', '.join(['%s'] * len(pks))
+    for field in model._meta.many_to_many:
+        cursor.execute('DELETE FROM {table} WHERE {column} IN ({placeholders})'.format(
+            table=qn(field.rel.through._meta.db_table),
+            column=qn(field.m2m_column_name()),
+            placeholders=placeholders), list(pks))
+    # children before parents
+    for level in reversed(utils.get_concrete_models(model)):
+        cursor.execute('DELETE FROM {table} WHERE {pk} IN ({placeholders})'.format(
+            table=qn(level._meta.db_table),
+            pk=qn(level._meta.pk.column),
+            placeholders=placeholders), list(pks))
+
+def prune_bundles(model, bundles, using, dry_run=False):
+    """ Prunes revisions from a handful of bundles, given as a dictionary of
+    bundle ids and lists of primary keys to prune, and returns the amount of
+    revisions and related rows that were deleted, and the bytes of text reclaimed. """
+
+    pks = exclude_referenced(model, [pk for cid in bundles for pk in bundles[cid]], using)
+    if not pks:
+        return 0, 0, 0
+    reclaimed = measure(model, pks, using)
+    related = count_related(model, pks, using)
+    if dry_run:
+        return len(pks), related, reclaimed
+
+    with utils.commit_on_success_unless_managed(using):
+        # Older revisions that store deltas (see revisions.storage) refer to the
+        # revision right after them, which might get pruned, so we store them
+        # against whatever revision comes after them once we're done.
+        pairs = []
+        if storage.get_delta_fields(model):
+            comparator = model.get_comparator_name()
+            revisions = model.objects.using(using).filter(cid__in=bundles.keys()).order_by('cid', comparator)
+            for cid, bundle in groupby(revisions, lambda revision: revision.cid):
+                bundle = list(bundle)
+                storage.resolve_revisions(bundle)
+                for i, revision in enumerate(bundle[:-1]):
+                    if revision.pk not in pks and bundle[i + 1].pk in pks:
+                        following = [r for r in bundle[i + 1:] if r.pk not in pks]
+                        pairs.append((revision, following[0]))
+
+        delete(model, list(pks), using)
+        storage.store_history(model, pairs, using)
+    return len(pks), related, reclaimed
+
+def prune(model, using, chunk_size=500, dry_run=False, now=None):
+    """ Applies the retention policy of a model, and returns the amount of
+    revisions and related rows that were (or, in a dry run, would be) deleted
+    and the bytes of text reclaimed. """
+
+    policy = get_policy(model)
+    if not policy:
+        return 0, 0, 0
+    now = now or datetime.now()
+    comparator = model.get_comparator_name()
+    date_field = policy.get('daily_after') is not None and get_date_field(model, policy) or None
+    publication_date = policy.get('keep_published') and model.Versioning.publication_date or None
+    columns = ['pk', 'cid'] + [name or 'pk' for name in (date_field, publication_date)]
+
+    revisions = model.objects.using(using)
+    totals = [0, 0, 0]
+    prunable = {}
+    last = None
+    while True:
+        # page through bundle ids, so we never have to hold all of them in memory
+        cids = revisions.order_by('cid').values_list('cid', flat=True).distinct()
+        if last is not None:
+            cids = cids.filter(cid__gt=last)
+        cids = list(cids[:chunk_size])
+        if not cids:
+            break
+        last = cids[-1]
+
+        rows = revisions.filter(cid__in=cids).order_by('cid', '-' + comparator).values_list(*columns)
+        for cid, bundle in groupby(rows, lambda row: row[1]):
+            pks = select_prunable(policy, [(pk, date_field and revision_date, publication_date and published)
+                for pk, cid, revision_date, published in bundle], now)
+            if pks:
+                prunable[cid] = pks
+            if sum(map(len, prunable.values())) >= chunk_size:
+                totals = [total + count for total, count in zip(totals, prune_bundles(model, prunable, using, dry_run))]
+                prunable = {}
+
+    if prunable:
+        totals = [total + count for total, count in zip(totals, prune_bundles(model, prunable, using, dry_run))]
+    return tuple(totals)
@@ -0,0 +1,324 @@
+# encoding: utf-8
+
+"""
+Delta storage for older revisions.
+
+Every revision is a full copy of a row, which adds up quickly for large
+text fields that get edited often. Models can list text fields in
+``Versioning.delta_fields``, and for those fields, older revisions only
+store the difference with the revision right after them::
+
+    class Story(VersionedModel):
+        body = models.TextField()
+
+        class Versioning:
+            delta_fields = ('body', )
+
+The latest revision always stores full values, so ``Model.latest`` and
+anything else that works with the latest revision is unaffected. When you
+access a delta field on an older revision, its value is reconstructed by
+walking back from the latest revision, which takes a single query. Revisions
+returned by ``get_revisions`` are reconstructed all at once, in memory.
+
+Fields listed in ``Versioning.compress_history`` are compressed (using
+zlib) when a revision stops being the latest one. They're decompressed
+when you access them, so fetching a bunch of revisions without looking at
+those fields doesn't cost anything extra. A field can store both deltas
+and compressed values, in which case the deltas get compressed.
+
+Keep in mind that ``values()``, ``values_list()`` and raw SQL return the
+stored deltas and compressed values rather than the full values. (The
+histories returned by ``get_history`` are reconstructed, though.)
+"""
+
+import base64
+import difflib
+import zlib
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, router
+from django.db.models.query_utils import DeferredAttribute
+from django.utils import simplejson
+
+# stored deltas and compressed values start with these prefixes, 
+# which won't occur in regular text
+DELTA_PREFIX = u'\x1edelta:'
+COMPRESSED_PREFIX = u'\x1ezlib:'
+
+
+def get_delta_fields(model):
+    """ The attribute names of the fields that store deltas on this model. """
+    return list(getattr(model.Versioning, 'delta_fields', ()))
+
+def get_compressed_fields(model):
+    """ The attribute names of the fields that are compressed on older revisions. """
+    return list(getattr(model.Versioning, 'compress_history', ()))
+
+def get_history_fields(model):
+    """ All fields that older revisions may store differently from the latest one. """
+    delta_fields = get_delta_fields(model)
+    return delta_fields + [name for name in get_compressed_fields(model) if name not in delta_fields]
+
+def is_delta(value):
+    return isinstance(value, basestring) and value.startswith(DELTA_PREFIX)
+
+def is_compressed(value):
+    return isinstance(value, basestring) and value.startswith(COMPRESSED_PREFIX)
+
+def compress(value):
+    """ Compresses text, unless that wouldn't save any space. """
+    if not isinstance(value, basestring) or is_compressed(value):
+        return value
+    compressed = COMPRESSED_PREFIX + base64.b64encode(zlib.compress(value.encode('utf-8')))
+    if len(compressed) < len(value):
+        return compressed
+    else:
+        return value
+
+def decompress(value):
+    if is_compressed(value):
+        return zlib.decompress(base64.b64decode(value[len(COMPRESSED_PREFIX):])).decode('utf-8')
+    else:
+        return value
+
+def make_delta(older, newer):
+    """
+    Describes ``older`` in terms of ``newer``: a list of ``[start, end]``
+    line ranges to copy from ``newer``, interspersed with literal text.
+    """
+    newer_lines = newer.splitlines(True)
+    older_lines = older.splitlines(True)
+    matcher = difflib.SequenceMatcher(None, newer_lines, older_lines, autojunk=False)
+    operations = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            operations.append([i1, i2])
+        elif tag in ('replace', 'insert'):
+            operations.append(u''.join(older_lines[j1:j2]))
+    return DELTA_PREFIX + simplejson.dumps(operations, separators=(',', ':'))
+
+def apply_delta(delta, newer):
+    newer_lines = newer.splitlines(True)
+    operations = simplejson.loads(delta[len(DELTA_PREFIX):])
+    chunks = []
+    for operation in operations:
+        if isinstance(operation, list):
+            chunks.extend(newer_lines[operation[0]:operation[1]])
+        else:
+            chunks.append(operation)
+    return u''.join(chunks)
+
+def patch(stored, newer):
+    stored = decompress(stored)
+    if is_delta(stored):
+        return apply_delta(stored, newer)
+    else:
+        return stored
+
+def compact(older, newer):
+    """ The value to store for ``older``: a delta against ``newer``, or
+    the full value if a delta wouldn't save any space. """
+    if not (isinstance(older, basestring) and isinstance(newer, basestring)):
+        return older
+    delta = make_delta(older, newer)
+    if len(delta) < len(older):
+        return delta
+    else:
+        return older
+
+
+def get_full_value(instance, attname):
+    value = instance.__dict__[attname]
+    if is_compressed(value):
+        value = instance.__dict__[attname] = decompress(value)
+    if is_delta(value):
+        resolve(instance)
+        value = instance.__dict__[attname]
+    return value
+
+
+class HistoryDescriptor(object):
+    """ Decompresses or reconstructs the full value of a field on an older 
+    revision when it's first accessed. """
+
+    def __init__(self, attname):
+        self.attname = attname
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        if self.attname not in instance.__dict__:
+            raise AttributeError(self.attname)
+        return get_full_value(instance, self.attname)
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.attname] = value
+
+
+class DeferredHistoryAttribute(DeferredAttribute):
+    """ Like ``HistoryDescriptor``, for fields that were left out with ``defer``
+    or ``only``: these are fetched on first access and then reconstructed. """
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        DeferredAttribute.__get__(self, instance, owner)
+        return get_full_value(instance, self.field_name)
+
+
+def install_descriptors(sender, **kwargs):
+    if not hasattr(sender, 'Versioning') or sender._meta.abstract:
+        return
+    # ``defer`` and ``only`` create subclasses that inherit our descriptors,
+    # except for deferred fields, which have to stay deferred
+    if sender._deferred:
+        for name in get_history_fields(sender):
+            attribute = sender.__dict__.get(name)
+            if isinstance(attribute, DeferredAttribute):
+                setattr(sender, name, DeferredHistoryAttribute(name, attribute.model_ref()))
+        return
+    for name in get_history_fields(sender):
+        field = sender._meta.get_field(name)
+        if field.get_internal_type() not in ('CharField', 'TextField') \
+            or name in ('cid', sender.get_comparator_name()):
+            raise ImproperlyConfigured("%s.Versioning.delta_fields and compress_history can only "
+                "contain text fields, other than the bundle id and the comparator." % sender.__name__)
+        setattr(sender, field.attname, HistoryDescriptor(field.attname))
+
+def resolve(instance):
+    """ Replaces any deltas on a model instance with full values, and returns
+    the names of the fields that needed reconstructing. """
+
+    for name in get_compressed_fields(instance.__class__):
+        if name in instance.__dict__:
+            instance.__dict__[name] = decompress(instance.__dict__[name])
+
+    attnames = [name for name in get_delta_fields(instance.__class__) if is_delta(instance.__dict__.get(name))]
+    if not attnames:
+        return []
+
+    comparator = instance.comparator_name
+    newer = instance.__class__.objects.using(instance._state.db) \
+        .filter(cid=instance.cid, **{comparator + '__gt': instance.comparator}) \
+        .order_by('-' + comparator).values_list(*attnames)
+
+    values = None
+    for row in newer:
+        if values is None:
+            values = [decompress(value) for value in row]
+        else:
+            values = [patch(stored, value) for stored, value in zip(row, values)]
+    if values is not None:
+        for name, value in zip(attnames, values):
+            instance.__dict__[name] = apply_delta(instance.__dict__[name], value)
+    return attnames
+
+def resolve_revisions(revisions):
+    """ Reconstructs all revisions in a bundle (ordered from oldest to newest)
+    without hitting the database. """
+
+    if not revisions:
+        return
+    attnames = get_delta_fields(revisions[0].__class__)
+    values = {}
+    for revision in reversed(revisions):
+        for name in attnames:
+            stored = decompress(revision.__dict__.get(name))
+            revision.__dict__[name] = stored
+            if is_delta(stored) and values.get(name) is not None:
+                revision.__dict__[name] = apply_delta(stored, values[name])
+            if is_delta(revision.__dict__.get(name)):
+                values[name] = None
+            else:
+                values[name] = revision.__dict__.get(name)
+
+def resolve_values(model, attnames, rows):
+    """ Like ``resolve_revisions``, but for the rows of a single bundle (from
+    oldest to newest) as returned by ``values_list``, with ``attnames`` naming
+    their columns. Returns the reconstructed rows as tuples. """
+
+    history_fields = get_history_fields(model)
+    indexes = [i for i, name in enumerate(attnames) if name in history_fields]
+    if not indexes:
+        return rows
+    rows = [list(row) for row in rows]
+    values = {}
+    for row in reversed(rows):
+        for i in indexes:
+            stored = decompress(row[i])
+            if is_delta(stored) and values.get(i) is not None:
+                stored = apply_delta(stored, values[i])
+            row[i] = stored
+            if is_delta(stored):
+                values[i] = None
+            else:
+                values[i] = stored
+    return [tuple(row) for row in rows]
+
+def get_previous(instance, using=None):
+    """ The revision right before this one, with full values. For a revision that
+    hasn't been saved yet and doesn't have a comparator value yet, that's the 
+    current latest revision. """
+
+    model = instance.__class__
+    if not get_history_fields(model) or not instance.cid:
+        return None
+
+    using = using or router.db_for_write(model, instance=instance)
+    comparator = instance.comparator_name
+    revisions = model.objects.using(using).filter(cid=instance.cid)
+    # (new revisions can come before the latest one, if they're given a 
+    # lower comparator value)
+    if instance.comparator is not None:
+        revisions = revisions.filter(**{comparator + '__lt': instance.comparator})
+    for previous in revisions.order_by('-' + comparator)[:1]:
+        resolve(previous)
+        return previous
+    return None
+
+def store(model, revisions, using):
+    """ Writes the stored values for delta fields of revisions, given as
+    ``(pk, {attname: value})`` tuples, with one query per table. """
+
+    revisions = list(revisions)
+    if not revisions:
+        return
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+
+    tables = {}
+    for name in get_history_fields(model):
+        field = model._meta.get_field(name)
+        tables.setdefault(field.model, []).append(field)
+    for table_model, fields in tables.items():
+        sql = 'UPDATE {table} SET {assignments} WHERE {pk} = %s'.format(
+            table=qn(table_model._meta.db_table),
+            assignments=', '.join(['%s = %%s' % qn(field.column) for field in fields]),
+            pk=qn(table_model._meta.pk.column))
+        rows = [[field.get_db_prep_save(values[field.attname], connection=connection) for field in fields] + [pk]
+            for pk, values in revisions]
+        cursor.executemany(sql, rows)
+
+def get_history_value(model, name, older, newer):
+    """ What to store for a field on a revision that's no longer the latest one. """
+    if name in get_delta_fields(model):
+        older = compact(older, newer)
+    if name in get_compressed_fields(model):
+        older = compress(older)
+    return older
+
+def store_history(model, pairs, using):
+    """ Stores older revisions as deltas against the revisions right after
+    them and compresses them, for a list of ``(older, newer)`` model instances. """
+
+    attnames = get_history_fields(model)
+    store(model, [(older.pk, dict([(name, get_history_value(model, name, older.__dict__[name], getattr(newer, name))) 
+        for name in attnames])) for older, newer in pairs if older is not None], using)
+
+def store_full(model, revisions, using):
+    """ Stores the full values of revisions that are no longer followed by
+    the revision their deltas were made against. """
+
+    attnames = get_history_fields(model)
+    store(model, [(revision.pk, dict([(name, revision.__dict__[name]) for name in attnames]))
+        for revision in revisions if revision is not None], using)
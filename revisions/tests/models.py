@@ -1,6 +1,6 @@
 from django.db import models
 from revisions.models import VersionedModelBase, VersionedModel, TrashableModel
-from revisions import shortcuts
+from revisions import shortcuts, fields
 from django.template.defaultfilters import slugify
 from revisions import managers
 from django_extensions.db.fields import UUIDField
@@ -68,6 +68,17 @@ class UUIDStory(VersionedModelBase):
         publication_date = None
         comparator = 'changed'
 
+class NumberedStory(VersionedModel):
+    # serves to test comparators stored in a differently named column, 
+    # and revisions that don't come last
+    title = models.CharField(max_length=250)
+    number = models.IntegerField(db_column='revision_number')
+    body = models.TextField(blank=True)
+
+    class Versioning:
+        comparator = 'number'
+        delta_fields = ('body', )
+
 class UniqueStory(VersionedModel):
     class Meta:
         verbose_name_plural = 'unique stories'
@@ -88,6 +99,49 @@ class UniqueStory(VersionedModel):
     def __unicode__(self):
         return self.title
 
+class IndexedStory(VersionedModel):
+    # serves to test the latest revision pointer table
+    title = models.CharField(max_length=250)
+    slug = models.SlugField(max_length=250, editable=False)
+    body = models.TextField(blank=True)
+
+    def save(self, *vargs, **kwargs):
+        self.slug = slugify(self.title)
+        super(IndexedStory, self).save(*vargs, **kwargs)
+
+    def __unicode__(self):
+        return self.title
+
+    class Meta:
+        verbose_name_plural = 'indexed stories'
+
+    class Versioning:
+        clear_each_revision = ['title', 'slug']
+        publication_date = None
+        latest_table = True
+
+class DeltaStory(VersionedModel):
+    # serves to test storing older revisions as deltas
+    title = models.CharField(max_length=250)
+    body = models.TextField(blank=True)
+
+    class Meta:
+        verbose_name_plural = 'delta stories'
+
+    class Versioning:
+        delta_fields = ('body', )
+
+class CompressedStory(VersionedModel):
+    # serves to test compressing older revisions
+    title = models.CharField(max_length=250)
+    body = models.TextField(blank=True)
+
+    class Meta:
+        verbose_name_plural = 'compressed stories'
+
+    class Versioning:
+        compress_history = ('body', )
+
 class FancyStory(Story):
     is_very_fancy = models.BooleanField(default=True)
 
@@ -128,6 +182,57 @@ class Aside(VersionedModel):
     message = models.CharField(max_length=250)
     story = models.ForeignKey(Story) 
 
+class Tag(models.Model):
+    name = models.CharField(max_length=50)
+
+class TaggedStory(VersionedModel):
+    # serves to test copying many-to-many relations to new revisions
+    title = models.CharField(max_length=250)
+    tags = models.ManyToManyField(Tag)
+    weighted_tags = models.ManyToManyField(Tag, through='Tagging', related_name='weighted_stories')
+
+    class Meta:
+        verbose_name_plural = 'tagged stories'
+
+class LinkedStory(VersionedModel):
+    # serves to test copying symmetrical many-to-many relations
+    title = models.CharField(max_length=250)
+    see_also = models.ManyToManyField('self', blank=True)
+
+    class Meta:
+        verbose_name_plural = 'linked stories'
+
+class Tagging(models.Model):
+    story = models.ForeignKey(TaggedStory)
+    tag = models.ForeignKey(Tag)
+    weight = models.IntegerField(default=1)
+
+class PrunableStory(VersionedModel):
+    # serves to test retention policies
+    title = models.CharField(max_length=250)
+    body = models.TextField(blank=True)
+    published = models.DateTimeField(null=True, blank=True)
+    tags = models.ManyToManyField(Tag)
+
+    class Meta:
+        verbose_name_plural = 'prunable stories'
+
+    class Versioning:
+        publication_date = 'published'
+        delta_fields = ('body', )
+        retention = {
+            'keep_last': 3,
+            'keep_published': True,
+            }
+
+class FancyPrunableStory(PrunableStory):
+    is_very_fancy = models.BooleanField(default=True)
+
+class Footnote(models.Model):
+    # serves to test that revisions that are referenced elsewhere don't get pruned
+    content = models.CharField(max_length=250)
+    story = models.ForeignKey(PrunableStory)
+
 class Info(models.Model):
     # serves to test related but unversioned objects
     content = models.CharField(max_length=250)
@@ -136,4 +241,4 @@ class Info(models.Model):
 class InfoToBundle(models.Model):
     # serves to test FKs to a bundle
     content = models.CharField(max_length=250)
-    #story = models.ForeignKey(Story, to_field='cid')
\ No newline at end of file
+    story = fields.ForeignKey(Story)
\ No newline at end of file
@@ -1,9 +1,19 @@
+import sys
+import tempfile
 from copy import copy
-from django.db import IntegrityError
-from django.test import TestCase
+from StringIO import StringIO
+from datetime import datetime, timedelta
+from django.db import IntegrityError, connection, transaction
+from django.core.management import call_command
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_init
+from django.test import TestCase, TransactionTestCase
 from django.test.client import Client
 from django.contrib.auth.models import User
+from django.utils.http import urlquote
 import revisions
+from revisions import diff, fields, latest, managers, registry, retention, storage, trash
 from revisions.tests import models
 
 #
@@ -34,6 +44,30 @@ class ModelTests(TestCase):
         prevnext_vid = self.story.get_revisions().prev.get_revisions().next.pk
         self.assertEquals(revision_vid, prevnext_vid)
 
+    def test_get_revisions_cache(self):
+        with self.assertNumQueries(1):
+            revisions = self.story.get_revisions()
+            self.assertEquals(len(revisions), 3)
+            self.assertEquals(revisions.prev, revisions[1])
+            self.assertEquals(revisions.next, None)
+            self.assertEquals(revisions.latest(), self.story)
+            self.assertEquals(self.story.get_latest_revision(), self.story)
+            self.assertEquals(len(self.story.get_revisions()), 3)
+
+        revision = self.story.revise()
+        self.assertEquals(len(self.story.get_revisions()), 4)
+        self.assertEquals(self.story.get_revisions().next, revision)
+
+    def test_check_if_latest_revision(self):
+        story = self.story.__class__.objects.get(pk=self.story.pk)
+        older = self.story.__class__.objects.get(pk=self.story.get_revisions().prev.pk)
+        with self.assertNumQueries(2):
+            self.assertTrue(story.check_if_latest_revision())
+            self.assertFalse(older.check_if_latest_revision())
+        # answered from the cached bundle
+        with self.assertNumQueries(0):
+            self.assertTrue(self.story.check_if_latest_revision())
+
     def test_id_assignment(self):
         obj = self.story.__class__(
             title = 'this is a title',
@@ -95,6 +129,33 @@ class ModelTests(TestCase):
         self.assertEquals(actual['latest_revisions'][0].title, 'This is a little story (final)')
         self.assertTrue(expected['old_revision_pks'].isdisjoint(actual['latest_revision_pks']))
 
+    def test_raw_access(self):
+        cls = self.story.__class__
+        with managers.raw_access:
+            self.assertEquals(cls.latest.count(), cls.objects.count())
+        self.assertTrue(cls.latest.count() < cls.objects.count())
+
+    def test_latest_count(self):
+        """ Counting the latest revisions should happen entirely in the database. """
+
+        cls = self.story.__class__
+        instances = []
+        def track_instances(sender, instance, **kwargs):
+            instances.append(instance)
+
+        post_init.connect(track_instances)
+        try:
+            with self.assertNumQueries(1):
+                count = cls.latest.count()
+            with self.assertNumQueries(1):
+                exists = cls.latest.exists()
+        finally:
+            post_init.disconnect(track_instances)
+        
+        self.assertEquals(instances, [])
+        self.assertEquals(count, len(set([story.cid for story in cls.latest.all()])))
+        self.assertTrue(exists)
+
     def test_fetch_by_pk(self, pk=2):
         story = self.story.__class__.fetch(pk)
         self.assertEquals(story.pk, pk)
@@ -170,6 +231,120 @@ class FancyBaseModelTests(ModelTests):
     def setUp(self):
         self.story = models.FancyManualStory.latest.all()[0]
 
+class LatestTableTests(ModelTests):
+    fixtures = ['indexed_revisions_scenario', 'asides_scenario', ]
+
+    def setUp(self):
+        self.story = models.IndexedStory.latest.all()[0]
+
+    def test_pointer_follows_revisions(self):
+        revision = self.story.revise()
+        self.assertEquals(models.IndexedStory.latest.get(cid=self.story.cid).pk, revision.pk)
+        revision.delete_revision()
+        self.assertEquals(models.IndexedStory.latest.get(cid=self.story.cid).pk, self.story.pk)
+        self.story.delete()
+        self.assertFalse(models.IndexedStory.latest.filter(cid=self.story.cid).exists())
+        self.assertEquals(latest.verify_latest_table(models.IndexedStory), [])
+
+    def test_update_and_delete(self):
+        revision = self.story.revise()
+        self.assertEquals(models.IndexedStory.latest.filter(cid=self.story.cid).update(title="Updated"), 1)
+        self.assertEquals(models.IndexedStory.objects.get(pk=revision.pk).title, "Updated")
+        self.assertEquals(models.IndexedStory.objects.get(pk=self.story.pk).title, self.story.title)
+        models.IndexedStory.latest.filter(cid=self.story.cid).delete()
+        self.assertFalse(models.IndexedStory.objects.filter(cid=self.story.cid).exists())
+        self.assertEquals(latest.verify_latest_table(models.IndexedStory), [])
+
+    def test_pointer_follows_plain_deletes(self):
+        revision = self.story.revise()
+        models.IndexedStory.objects.filter(pk=revision.pk).delete()
+        self.assertEquals(models.IndexedStory.latest.get(cid=self.story.cid).pk, self.story.pk)
+        self.assertEquals(latest.verify_latest_table(models.IndexedStory), [])
+
+    def test_rebuild_latest(self):
+        connection.cursor().execute('DELETE FROM %s' % latest.get_latest_table(models.IndexedStory))
+        self.assertEquals(len(latest.verify_latest_table(models.IndexedStory)), 2)
+        call_command('rebuild_latest', 'tests.IndexedStory', verbosity=0)
+        self.assertEquals(latest.verify_latest_table(models.IndexedStory), [])
+
+class LatestTableTransactionTests(TransactionTestCase):
+    fixtures = ['indexed_revisions_scenario', ]
+
+    def setUp(self):
+        self.update_latest_pointers = latest.update_latest_pointers
+
+    def tearDown(self):
+        latest.update_latest_pointers = self.update_latest_pointers
+        # flushing the database doesn't touch the pointer table
+        connection.cursor().execute('DELETE FROM %s' % latest.get_latest_table(models.IndexedStory))
+        transaction.commit_unless_managed()
+
+    def test_failed_pointer_update_rolls_back_save(self):
+        story = models.IndexedStory.latest.all()[0]
+        count = models.IndexedStory.objects.count()
+        def fail(*vargs, **kwargs):
+            raise IntegrityError()
+        latest.update_latest_pointers = fail
+        self.assertRaises(IntegrityError, story.revise)
+        latest.update_latest_pointers = self.update_latest_pointers
+        self.assertEquals(models.IndexedStory.objects.count(), count)
+        self.assertEquals(latest.verify_latest_table(models.IndexedStory), [])
+
+class CallerTransactionTests(TransactionTestCase):
+    def test_save_leaves_managed_transactions_alone(self):
+        @transaction.commit_manually
+        def save_and_roll_back():
+            models.Story(title="A story that never was").save()
+            transaction.rollback()
+        save_and_roll_back()
+        self.assertFalse(models.Story.objects.filter(title="A story that never was").exists())
+
+class LatestViewTests(ModelTests):
+    def setUp(self):
+        self.optimize = getattr(settings, 'OPTIMIZE_REVISIONS', False)
+        settings.OPTIMIZE_REVISIONS = True
+        latest.create_latest_view(models.Story)
+        super(LatestViewTests, self).setUp()
+
+    def tearDown(self):
+        settings.OPTIMIZE_REVISIONS = self.optimize
+
+    def test_latest_view_is_used(self):
+        sql = str(models.Story.latest.all().query)
+        self.assertTrue(latest.get_latest_view(models.Story) in sql)
+
+    def test_latest_view_custom_comparator(self):
+        call_command('loaddata', 'uuidmodel_revisions_scenario', verbosity=0)
+        latest.create_latest_view(models.UUIDStory)
+        pks = set(models.UUIDStory.latest.values_list('pk', flat=True))
+        self.assertEquals(pks, set(["ghi", "bbb"]))
+
+class SubqueryStrategyTests(ModelTests):
+    strategy = 'subquery'
+
+    def setUp(self):
+        self.forced = getattr(settings, 'REVISIONS_LATEST_STRATEGY', None)
+        settings.REVISIONS_LATEST_STRATEGY = self.strategy
+        if latest.get_strategy(models.Story).name != self.strategy:
+            self.skipTest("The %s strategy isn't available on this database." % self.strategy)
+        super(SubqueryStrategyTests, self).setUp()
+
+    def tearDown(self):
+        settings.REVISIONS_LATEST_STRATEGY = self.forced
+
+    def test_comparator_column(self):
+        story = models.NumberedStory(title="A numbered story", number=2)
+        story.save()
+        older = models.NumberedStory(title="A numbered story", number=1, cid=story.cid)
+        older.save()
+        self.assertEquals(models.NumberedStory.latest.get(cid=story.cid).pk, story.pk)
+
+class WindowStrategyTests(SubqueryStrategyTests):
+    strategy = 'window'
+
+class DistinctOnStrategyTests(SubqueryStrategyTests):
+    strategy = 'distinct_on'
+
 class UniquenessTests(TestCase):
     def setUp(self):
         self.story = models.UniqueStory(title="hello", body="there")
@@ -197,6 +372,461 @@ class UniquenessTests(TestCase):
         new_story = models.UniqueStory(title="howdy", body="there")
         self.assertRaises(IntegrityError, new_story.save)
 
+class CloneTests(TestCase):
+    def test_revise_many_to_many(self):
+        tags = [models.Tag.objects.create(name=str(i)) for i in range(10)]
+        story = models.TaggedStory(title="Tagged")
+        story.save()
+        story.tags.add(*tags)
+        for i, tag in enumerate(tags):
+            models.Tagging.objects.create(story=story, tag=tag, weight=i)
+
+        # the amount of queries doesn't depend on the amount of tags
+        with self.assertNumQueries(3):
+            revision = story.revise()
+        self.assertEquals(revision.tags.count(), 10)
+        self.assertEquals(
+            list(revision.tagging_set.order_by('weight').values_list('tag', 'weight')), 
+            [(tag.pk, i) for i, tag in enumerate(tags)])
+
+    def test_revise_symmetrical_many_to_many(self):
+        story = models.LinkedStory(title="A story")
+        story.save()
+        other = models.LinkedStory(title="Another story")
+        other.save()
+        story.see_also.add(other)
+        revision = story.revise()
+        self.assertEquals(list(revision.see_also.all()), [other])
+        # (other.see_also only has latest revisions)
+        through = models.LinkedStory.see_also.through.objects
+        self.assertEquals(sorted(through.filter(from_linkedstory=other).values_list('to_linkedstory', flat=True)), 
+            [story.pk, revision.pk])
+
+class BulkReviseTests(TestCase):
+    fixtures = ['revisions_scenario', 'indexed_revisions_scenario', ]
+
+    def test_bulk_revise(self):
+        stories = [models.Story(title="Story %i" % i, body="Once upon a time") for i in range(5)]
+        for story in stories:
+            story.save()
+        stories[0].title = "A different title"
+
+        # one query to insert, one to find out the new primary keys,
+        # none to copy many-to-many relations
+        with self.assertNumQueries(2):
+            revisions = models.Story.latest.bulk_revise(stories)
+        self.assertEquals([revision.cid for revision in revisions], [story.cid for story in stories])
+        self.assertEquals(revisions[0].title, "A different title")
+        for story, revision in zip(stories, revisions):
+            self.assertTrue(revision.pk > story.pk)
+            self.assertEquals(models.Story.latest.get(cid=story.cid).pk, revision.pk)
+            self.assertEquals(len(story.get_revisions()), 2)
+
+    def test_queryset_revise(self):
+        story = models.Story.latest.all()[0]
+        revisions = models.Story.latest.filter(cid=story.cid).revise()
+        self.assertEquals(len(revisions), 1)
+        self.assertEquals(len(story.get_revisions()), 4)
+        self.assertTrue(revisions[0].check_if_latest_revision())
+
+    def test_bulk_revise_inheritance(self):
+        stories = [models.FancyStory(title="Story %i" % i, is_very_fancy=False) for i in range(3)]
+        for story in stories:
+            story.save()
+        revisions = models.FancyStory.latest.bulk_revise(stories)
+        for revision in revisions:
+            revision = models.FancyStory.latest.get(cid=revision.cid)
+            self.assertEquals(revision.is_very_fancy, False)
+            self.assertEquals(len(revision.get_revisions()), 2)
+
+    def test_bulk_revise_many_to_many(self):
+        tags = [models.Tag.objects.create(name=name) for name in ('a', 'b', 'c')]
+        stories = [models.TaggedStory(title="Story %i" % i) for i in range(3)]
+        for story, tag in zip(stories, tags):
+            story.save()
+            story.tags.add(tag, tags[2])
+        revisions = models.TaggedStory.latest.bulk_revise(stories)
+        for story, revision in zip(stories, revisions):
+            self.assertEquals(
+                sorted([tag.pk for tag in revision.tags.all()]), 
+                sorted([tag.pk for tag in story.tags.all()]))
+
+    def test_bulk_revise_custom_through(self):
+        tag = models.Tag.objects.create(name='a')
+        stories = [models.TaggedStory(title="Story %i" % i) for i in range(3)]
+        for i, story in enumerate(stories):
+            story.save()
+            models.Tagging.objects.create(story=story, tag=tag, weight=i)
+        revisions = models.TaggedStory.latest.bulk_revise(stories)
+        for i, revision in enumerate(revisions):
+            self.assertEquals(revision.tagging_set.get().weight, i)
+
+    def test_bulk_revise_pointer_table(self):
+        stories = list(models.IndexedStory.latest.all())
+        self.assertTrue(stories)
+        revisions = models.IndexedStory.latest.bulk_revise(stories)
+        self.assertEquals(latest.verify_latest_table(models.IndexedStory), [])
+        self.assertEquals(
+            sorted([story.pk for story in models.IndexedStory.latest.all()]),
+            sorted([revision.pk for revision in revisions]))
+
+    def test_bulk_revise_uniqueness(self):
+        first = models.UniqueStory(title="first", body="first")
+        second = models.UniqueStory(title="second", body="second")
+        first.save()
+        second.save()
+        # unique per bundle: clashes with the latest revision of another bundle
+        second.body = "first"
+        self.assertRaises(IntegrityError, models.UniqueStory.latest.bulk_revise, [second])
+        # ... or with another instance in the same batch
+        first.body = second.body = "third"
+        self.assertRaises(IntegrityError, models.UniqueStory.latest.bulk_revise, [first, second])
+        self.assertEquals(models.UniqueStory.objects.count(), 2)
+
+    def test_bulk_revise_bundle_once(self):
+        story = models.Story.latest.all()[0]
+        self.assertRaises(ValueError, models.Story.latest.bulk_revise, [story, story])
+        self.assertRaises(ValueError, models.Story.latest.bulk_revise, [models.Story(title="unsaved")])
+
+class DeltaStorageTests(TestCase):
+    def setUp(self):
+        self.paragraphs = ["Paragraph %i, which is long enough to be worth storing just once.\n" % i for i in range(50)]
+        self.bodies = []
+        story = models.DeltaStory(title="Deltas", body="".join(self.paragraphs))
+        story.save()
+        self.bodies.append(story.body)
+        for i in range(5):
+            story.body = story.body.replace("Paragraph %i," % (i * 10), "Edited paragraph %i," % i)
+            story = story.revise()
+            self.bodies.append(story.body)
+        self.story = story
+
+    def get_stored(self):
+        return list(models.DeltaStory.objects.filter(cid=self.story.cid).order_by('vid').values_list('body', flat=True))
+
+    def test_older_revisions_store_deltas(self):
+        stored = self.get_stored()
+        self.assertEquals(stored[-1], self.bodies[-1])
+        for value in stored[:-1]:
+            self.assertTrue(storage.is_delta(value))
+        self.assertTrue(sum(map(len, stored)) < 2 * len(self.bodies[0]))
+
+    def test_get_revisions(self):
+        with self.assertNumQueries(1):
+            bodies = [revision.body for revision in self.story.get_revisions()]
+        self.assertEquals(bodies, self.bodies)
+
+    def test_get_history(self):
+        with self.assertNumQueries(1):
+            bodies = [body for body, pk in self.story.body_history]
+        self.assertEquals(bodies, self.bodies)
+
+    def test_fetch(self):
+        revisions = self.story.get_revisions()
+        for revision, body in zip(revisions, self.bodies):
+            self.assertEquals(models.DeltaStory.fetch(revision.pk).body, body)
+        # one query to fetch the revision, one to reconstruct it
+        with self.assertNumQueries(2):
+            models.DeltaStory.objects.get(pk=revisions[0].pk).body
+
+    def test_revert_to(self):
+        first = self.story.get_revisions()[0]
+        revision = self.story.revert_to(first.pk)
+        self.assertEquals(models.DeltaStory.latest.get(cid=self.story.cid).body, self.bodies[0])
+        self.assertEquals([r.body for r in revision.get_revisions()], self.bodies + self.bodies[:1])
+
+    def test_update_old_revision_in_place(self):
+        revision = self.story.get_revisions()[2]
+        revision.body = "Something else entirely.\n"
+        revision.save()
+        self.bodies[2] = revision.body
+        self.assertEquals([r.body for r in self.story.get_revisions()], self.bodies)
+        self.assertEquals([models.DeltaStory.objects.get(pk=r.pk).body for r in self.story.get_revisions()], self.bodies)
+
+    def test_delete_revision(self):
+        self.story.delete_revision()
+        story = models.DeltaStory.latest.get(cid=self.story.cid)
+        self.assertEquals(story.body, self.bodies[-2])
+        self.assertEquals(self.get_stored()[-1], self.bodies[-2])
+        self.assertEquals([r.body for r in story.get_revisions()], self.bodies[:-1])
+
+    def test_bulk_revise(self):
+        self.story.body = "Bulk edit.\n" + self.story.body
+        revision = models.DeltaStory.latest.bulk_revise([self.story])[0]
+        self.bodies.append(revision.body)
+        stored = self.get_stored()
+        self.assertEquals(stored[-1], revision.body)
+        self.assertTrue(storage.is_delta(stored[-2]))
+        self.assertEquals([r.body for r in revision.get_revisions()], self.bodies)
+
+    def test_revision_before_latest(self):
+        newer = models.NumberedStory(title="Numbered", number=2, body=self.bodies[-1])
+        newer.save()
+        older = models.NumberedStory(title="Numbered", number=1, body=self.bodies[0], cid=newer.cid)
+        older.save()
+        stored = models.NumberedStory.objects.get(pk=newer.pk).__dict__['body']
+        self.assertFalse(storage.is_delta(stored))
+        self.assertEquals(models.NumberedStory.latest.get(cid=newer.cid).body, self.bodies[-1])
+        self.assertEquals(models.NumberedStory.objects.get(pk=older.pk).body, self.bodies[0])
+
+    def test_plain_delete(self):
+        revisions = list(self.story.get_revisions())
+        models.DeltaStory.objects.filter(pk=revisions[3].pk).delete()
+        self.story.clear_revisions_cache()
+        self.assertEquals([revision.body for revision in self.story.get_revisions()], 
+            self.bodies[:3] + self.bodies[4:])
+        self.assertEquals(models.DeltaStory.objects.get(pk=revisions[2].pk).body, self.bodies[2])
+
+    def test_deferred_fields(self):
+        latest = models.DeltaStory.objects.only('title').get(pk=self.story.pk)
+        latest.save()
+        self.assertEquals(models.DeltaStory.objects.get(pk=self.story.pk).body, self.bodies[-1])
+        first = self.story.get_revisions()[0]
+        self.assertEquals(models.DeltaStory.objects.defer('body').get(pk=first.pk).body, self.bodies[0])
+
+class CompressedStorageTests(TestCase):
+    def setUp(self):
+        self.bodies = []
+        story = models.CompressedStory(title="Compressed", body="All work and no play makes Jack a dull boy. " * 100)
+        story.save()
+        for i in range(3):
+            self.bodies.append(story.body)
+            story.body = story.body + "Revision %i." % i
+            story = story.revise()
+        self.bodies.append(story.body)
+        self.story = story
+
+    def test_older_revisions_are_compressed(self):
+        stored = list(models.CompressedStory.objects.filter(cid=self.story.cid).order_by('vid').values_list('body', flat=True))
+        self.assertEquals(stored[-1], self.bodies[-1])
+        for value, body in zip(stored[:-1], self.bodies):
+            self.assertTrue(storage.is_compressed(value))
+            self.assertTrue(len(value) < len(body) / 10)
+
+    def test_lazy_decompression(self):
+        revisions = list(self.story.get_revisions())
+        self.assertTrue(storage.is_compressed(revisions[0].__dict__['body']))
+        self.assertEquals([revision.body for revision in revisions], self.bodies)
+        self.assertEquals([body for body, pk in self.story.body_history], self.bodies)
+        self.assertEquals(models.CompressedStory.fetch(revisions[0].pk).body, self.bodies[0])
+
+    def test_deferred_fields(self):
+        latest = models.CompressedStory.objects.only('title').get(pk=self.story.pk)
+        latest.save()
+        self.assertEquals(models.CompressedStory.objects.get(pk=self.story.pk).body, self.bodies[-1])
+        first = self.story.get_revisions()[0]
+        self.assertEquals(models.CompressedStory.objects.defer('body').get(pk=first.pk).body, self.bodies[0])
+
+    def test_revert_to(self):
+        first = self.story.get_revisions()[0]
+        self.story.revert_to(first.pk)
+        self.assertEquals(models.CompressedStory.latest.get(cid=self.story.cid).body, self.bodies[0])
+
+    def test_compressed_deltas(self):
+        newer = u"One line.\nAnother line.\n" * 20
+        older = newer.replace(u"Another", u"Yet another", 1)
+        delta = storage.compress(storage.make_delta(older, newer))
+        self.assertEquals(storage.patch(delta, newer), older)
+
+class RetentionTests(TestCase):
+    def make_story(self, model=models.PrunableStory, revisions=10):
+        tag = models.Tag.objects.create(name='tag')
+        story = model(title="Prunable", body="".join(["Line %i\n" % i for i in range(20)]))
+        story.save()
+        story.tags.add(tag)
+        bodies = [story.body]
+        for i in range(revisions - 1):
+            story.body = story.body.replace("Line %i\n" % i, "Edited line %i\n" % i)
+            story = story.revise()
+            bodies.append(story.body)
+        return story, bodies
+
+    def test_select_prunable(self):
+        now = datetime(2011, 6, 1, 12)
+        revisions = [(10 - i, now - timedelta(hours=i * 8), None) for i in range(10)]
+        self.assertEquals(retention.select_prunable({'keep_last': 3}, revisions, now), [7, 6, 5, 4, 3, 2, 1])
+        # revisions from the last day are kept, after that one per day
+        self.assertEquals(retention.select_prunable({'daily_after': 1}, revisions, now), [6, 4, 3, 1])
+        published = [(pk, revision_date, pk == 2 and now or None) for pk, revision_date, publication_date in revisions]
+        self.assertEquals(retention.select_prunable({'keep_last': 3, 'keep_published': True}, published, now), [7, 6, 5, 4, 3, 1])
+
+    def test_measure_bytes(self):
+        story = models.PrunableStory(title=u"Caf\xe9", body=u"\u201cQuoted\u201d")
+        story.save()
+        expected = sum([len(getattr(story, field.attname).encode('utf-8')) for field in story._meta.fields
+            if field.get_internal_type() in ('CharField', 'TextField', 'SlugField')])
+        self.assertEquals(retention.measure(models.PrunableStory, [story.pk], 'default'), expected)
+
+    def test_prune(self):
+        story, bodies = self.make_story()
+        revisions = story.get_revisions()
+        published = revisions[1]
+        published.published = datetime.now()
+        published.save()
+
+        revisions, related, reclaimed = retention.prune(models.PrunableStory, using='default')
+        self.assertEquals((revisions, related), (6, 6))
+        self.assertTrue(reclaimed > 0)
+        remaining = models.PrunableStory.latest.get(cid=story.cid).get_revisions()
+        self.assertEquals([revision.pk for revision in remaining], [published.pk] + [r.pk for r in story.get_revisions()][-3:])
+        # deltas are still reconstructed properly
+        self.assertEquals([revision.body for revision in remaining], [bodies[1]] + bodies[-3:])
+        self.assertEquals(models.PrunableStory.objects.get(pk=published.pk).body, bodies[1])
+        self.assertEquals(models.PrunableStory.tags.through.objects.count(), 4)
+
+    def test_prune_referenced_revisions(self):
+        story, bodies = self.make_story()
+        first = story.get_revisions()[0]
+        models.Footnote.objects.create(content="Footnote", story=first)
+        retention.prune(models.PrunableStory, using='default')
+        story.clear_revisions_cache()
+        self.assertEquals([revision.pk for revision in story.get_revisions()][0], first.pk)
+        self.assertEquals(len(story.get_revisions()), 4)
+
+    def test_prune_inheritance(self):
+        story, bodies = self.make_story(model=models.FancyPrunableStory)
+        # bundles of a subclass are left alone when pruning the parent model...
+        self.assertEquals(retention.prune(models.PrunableStory, using='default')[0], 0)
+        # ... and pruned from both tables when pruning the subclass itself
+        self.assertEquals(retention.prune(models.FancyPrunableStory, using='default')[0], 7)
+        self.assertEquals(models.FancyPrunableStory.objects.count(), 3)
+        self.assertEquals(models.PrunableStory.objects.count(), 3)
+        self.assertEquals([revision.body for revision in story.get_revisions()], bodies[-3:])
+
+    def test_prune_revisions_command(self):
+        story, bodies = self.make_story()
+        call_command('prune_revisions', 'tests.PrunableStory', dry_run=True, verbosity=0)
+        self.assertEquals(len(story.get_revisions()), 10)
+        call_command('prune_revisions', 'tests.PrunableStory', chunk_size=2, verbosity=0)
+        story.clear_revisions_cache()
+        self.assertEquals(len(story.get_revisions()), 3)
+
+class DiffTests(TestCase):
+    fixtures = ['revisions_scenario', ]
+
+    def test_opcodes(self):
+        a, b = list("abcabba"), list("cbabac")
+        codes = list(diff.opcodes(a, b))
+        result = []
+        for tag, i1, i2, j1, j2 in codes:
+            if tag == 'equal':
+                self.assertEquals(a[i1:i2], b[j1:j2])
+            result.extend(b[j1:j2])
+        self.assertEquals(result, b)
+        # the shortest edit script keeps 4 out of 7 elements
+        self.assertEquals(sum([i2 - i1 for tag, i1, i2, j1, j2 in codes if tag == 'equal']), 4)
+
+    def test_granularity(self):
+        old, new = u"One line.\nThe quick brown fox.\n", u"One line.\nThe slow brown fox.\n"
+        self.assertEquals(list(diff.chunks(old, new, 'line')), 
+            [('equal', u"One line.\n", u"One line.\n"), ('replace', u"The quick brown fox.\n", u"The slow brown fox.\n")])
+        self.assertEquals([chunk for chunk in diff.chunks(old, new, 'word') if chunk[0] != 'equal'], 
+            [('replace', u"quick", u"slow")])
+        self.assertEquals([chunk for chunk in diff.chunks(u"color", u"colour", 'char') if chunk[0] != 'equal'], 
+            [('insert', u"", u"u")])
+        self.assertRaises(ValueError, list, diff.chunks(old, new, 'sentence'))
+
+    def test_unified(self):
+        lines = list(diff.unified(u"a\nb\nc\n", u"a\nB\nc\n", 'old', 'new'))
+        self.assertEquals(lines, ['--- old\n', '+++ new\n', '@@ -1,3 +1,3 @@\n', u' a\n', u'-b\n', u'+B\n', u' c\n'])
+
+    def test_timeout(self):
+        old, new = u" ".join([str(i) for i in range(2000)]), u" ".join([str(i * 7 + 1) for i in range(2000)])
+        chunks = list(diff.chunks(u"start " + old + u" end", u"start " + new + u" end", 'word', timeout=0))
+        self.assertEquals(chunks, [('equal', u"start ", u"start "), ('replace', old, new), ('equal', u" end", u" end")])
+
+    def test_show_diff_to(self):
+        revisions = models.Story.latest.all()[0].get_revisions()
+        html = revisions[0].show_diff_to(revisions[2], 'title')
+        self.assertTrue('<del>' in html or '<ins>' in html)
+        self.assertEquals(revisions[0].show_diff_to(revisions[0], 'title'), revisions[0].title)
+
+    def test_diff_to(self):
+        old = models.Story(title="A title", body="Some <b>text</b>.")
+        new = models.Story(title="A title", body="Some other <b>text</b>.")
+        changes = old.diff_to(new)
+        self.assertEquals([name for name, chunks in changes], ['body'])
+        self.assertEquals(u"".join(diff.html(old.body, new.body)), u"Some <ins>other </ins>&lt;b&gt;text&lt;/b&gt;.")
+
+class DiffCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        story = models.Story(title="A title", body="Once upon a time.")
+        story.save()
+        story.body = "Once upon a time, there was a story."
+        story = story.revise()
+        story.title = "Another title"
+        story = story.revise()
+        self.story = story
+        self.chunks = diff.chunks
+
+    def tearDown(self):
+        diff.chunks = self.chunks
+
+    def test_get_revision_diffs(self):
+        diffs = self.story.get_revision_diffs(fields=['title', 'body'])
+        pks = [revision.pk for revision in self.story.get_revisions()]
+        self.assertEquals([(older.pk, newer.pk) for older, newer, changes in diffs], zip(pks[:-1], pks[1:]))
+        self.assertEquals([name for name, chunks in diffs[0][2]], ['body'])
+        self.assertEquals([name for name, chunks in diffs[1][2]], ['title'])
+        self.assertEquals(diffs[0][2][0][1][-2], ('insert', u'', u', there was a story'))
+
+    def test_diffs_are_cached(self):
+        html = self.story.get_revisions()[0].show_diff_to(self.story, 'body')
+        diffs = self.story.get_revision_diffs()
+        # from now on, nothing should be diffed anymore
+        diff.chunks = None
+        self.assertEquals(self.story.get_revisions()[0].show_diff_to(self.story, 'body'), html)
+        self.assertEquals(self.story.get_revision_diffs(), diffs)
+
+    def test_in_place_updates(self):
+        first, second = self.story.get_revisions()[:2]
+        self.assertTrue('<ins>' in first.show_diff_to(second, 'body'))
+        second.body = first.body
+        second.save()
+        self.assertEquals(first.show_diff_to(second, 'body'), first.body)
+        self.assertEquals(self.story.get_revision_diffs(fields=['body'])[0][2], [])
+
+class DifferViewTests(TestCase):
+    urls = 'revisions.tests.urls'
+
+    def setUp(self):
+        self.paragraphs = [u"Paragraph %i.\n" % i for i in range(20)]
+        story = models.Story(title="A story", body="".join(self.paragraphs))
+        story.save()
+        self.first = story
+        for i in (2, 8, 14):
+            story.body = story.body.replace("Paragraph %i." % i, "Changed paragraph %i." % i)
+        self.second = story.revise()
+        self.url = '/stories/diff/%i/%i/' % (self.first.pk, self.second.pk)
+
+    def test_differ(self):
+        response = self.client.get(self.url)
+        self.assertEquals(response.status_code, 200)
+        # two out of three hunks per page, with one line of context
+        self.assertContains(response, '<ins>Changed paragraph</ins>', count=2)
+        self.assertContains(response, 'Paragraph 1.')
+        self.assertNotContains(response, 'Paragraph 5.')
+        response = self.client.get(self.url + '?page=2')
+        self.assertContains(response, '<ins>Changed paragraph</ins>', count=1)
+        self.assertEquals(self.client.get(self.url + '?page=3').status_code, 404)
+        response = self.client.get(self.url + '?granularity=line')
+        self.assertContains(response, '<ins>Changed paragraph 2.')
+
+    def test_differ_other_bundle(self):
+        other = models.Story(title="Another story")
+        other.save()
+        self.assertEquals(self.client.get('/stories/diff/%i/%i/' % (self.first.pk, other.pk)).status_code, 404)
+
+    def test_conditional_get(self):
+        response = self.client.get(self.url)
+        etag = response['ETag']
+        self.assertEquals(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEquals(self.client.get(self.url + '?page=2', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        self.second.body = "Something else altogether."
+        self.second.save()
+        self.assertEquals(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
 class ForeignKeyTests(TestCase):
     fixtures = ['revisions_scenario', ]
     
@@ -206,6 +836,61 @@ class ForeignKeyTests(TestCase):
     def test_foreign_key_to_bundle(self):
         info = models.InfoToBundle(content="Something something.", story=self.story)
         info.save() 
+        self.assertEquals(info.story_id, self.story.cid)
+
+    def test_assign_bundle_id(self):
+        info = models.InfoToBundle(content="Something something.", story=self.story)
+        info.story = self.story.revise().cid
+        self.assertEquals(info.story_id, self.story.cid)
+        self.assertTrue(info.story.check_if_latest_revision())
+
+    def test_dumpdata_loaddata(self):
+        info = models.InfoToBundle(content="Something something.", story=self.story)
+        info.save()
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            call_command('dumpdata', 'tests.InfoToBundle', format='json')
+            dump = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        models.InfoToBundle.objects.all().delete()
+        fixture = tempfile.NamedTemporaryFile(suffix='.json')
+        fixture.write(dump)
+        fixture.flush()
+        call_command('loaddata', fixture.name, verbosity=0, commit=False)
+        fixture.close()
+        self.assertEquals(models.InfoToBundle.objects.get(pk=info.pk).story_id, self.story.cid)
+
+    def test_resolves_to_latest_revision(self):
+        info = models.InfoToBundle(content="Something something.", story=self.story)
+        info.save()
+        story = self.story.revise()
+        info = models.InfoToBundle.objects.get(pk=info.pk)
+        with self.assertNumQueries(1):
+            self.assertEquals(info.story.pk, story.pk)
+
+    def test_lookups(self):
+        info = models.InfoToBundle(content="Something something.", story=self.story)
+        info.save()
+        old = self.story.get_revisions()[0]
+        self.assertEquals(list(models.InfoToBundle.objects.filter(story=old)), [info])
+        self.assertEquals(list(models.InfoToBundle.objects.filter(story=self.story.cid)), [info])
+
+    def test_select_bundles(self):
+        for story in models.Story.latest.all():
+            models.InfoToBundle(content="Something something.", story=story).save()
+        latest = dict([(story.cid, story.pk) for story in models.Story.latest.all()])
+        infos = list(models.InfoToBundle.objects.all())
+        with self.assertNumQueries(1):
+            fields.select_bundles(infos, 'story')
+        with self.assertNumQueries(0):
+            for info in infos:
+                self.assertEquals(info.story.pk, latest[info.story_id])
+
+    def test_formfield(self):
+        formfield = models.InfoToBundle._meta.get_field('story').formfield()
+        self.assertEquals(formfield.clean(self.story.cid), self.story)
 
 class ConvenienceTests(TestCase):
     fixtures = ['revisions_scenario', 'asides_scenario']
@@ -239,17 +924,65 @@ class ConvenienceTests(TestCase):
     def test_get_attribute_history(self):
         # get_attribute_history should be entirely functionally equivalent
         # to the list comprehension below
-        body_revisions = [(story.body, story) for story in self.story.get_revisions()]
+        body_revisions = [(story.body, story.pk) for story in self.story.get_revisions()]
         body_revisions_shortcut = story._get_attribute_history('body')
         
         self.assertEquals(body_revisions, body_revisions_shortcut)
 
+    def test_get_history(self):
+        revisions = self.story.get_revisions()
+        with self.assertNumQueries(1):
+            history = self.story.get_history(['title', 'body'])
+        self.assertEquals(history, [(story.comparator, story.pk, story.title, story.body) for story in revisions])
+
+    def test_queryset_get_history(self):
+        stories = self.story.__class__.latest.all()
+        with self.assertNumQueries(2):
+            histories = stories.get_history(['title'])
+        self.assertEquals(set(histories.keys()), set([story.cid for story in stories]))
+        for story in stories:
+            self.assertEquals([title for comparator, pk, title in histories[story.cid]], 
+                [revision.title for revision in story.get_revisions()])
+
     def test_getattr_history(self):
         """ This just tests the getattr magic, which is a shortcut to
         _get_attribute_history, which is tested separately. """
 
         self.assertEquals(self.story.body_history, self.story._get_attribute_history('body'))
 
+    def test_accessors(self):
+        model = self.story.__class__
+        self.assertTrue(hasattr(model, 'body_history'))
+        self.assertTrue(hasattr(model, 'related_aside_set'))
+        self.assertTrue(hasattr(models.TaggedStory, 'related_tags'))
+        self.assertFalse(hasattr(self.story, 'related_nothing'))
+        self.assertFalse(hasattr(self.story, 'nothing_history'))
+
+    def test_related_single_query(self):
+        expected = set(self.story._get_related_objects(self.story.aside_set))
+        story = self.story.__class__.latest.get(pk=self.story.pk)
+        with self.assertNumQueries(1):
+            self.assertEquals(set(story.related_aside_set), expected)
+
+    def test_related_distinct(self):
+        tag = models.Tag(name="news")
+        tag.save()
+        story = models.TaggedStory(title="A tagged story")
+        story.save()
+        story.tags.add(tag)
+        story = story.revise().revise()
+        self.assertEquals(list(story.related_tags), [tag] * 3)
+        self.assertEquals(list(story.related_objects('tags', distinct=True)), [tag])
+
+    def test_prefetch_related_revisions(self):
+        stories = self.story.__class__.latest.all()
+        expected = dict([(story.pk, set(story.related_aside_set)) for story in stories])
+        with self.assertNumQueries(3):
+            stories = list(stories.prefetch_related_revisions('aside_set'))
+        with self.assertNumQueries(0):
+            for story in stories:
+                self.assertEquals(set(story.related_aside_set), expected[story.pk])
+
     def test_getattr_related(self):
         """ This just tests the getattr magic, which is a shortcut to
         _get_related_objects, which is tested separately. """
@@ -259,6 +992,16 @@ class ConvenienceTests(TestCase):
         
         self.assertEquals(set(without_getattr), set(with_getattr))
 
+    def test_prefetch_revisions(self):
+        bundles = {}
+        for cid, pk in models.Story.objects.order_by('vid').values_list('cid', 'pk'):
+            bundles.setdefault(cid, []).append(pk)
+        with self.assertNumQueries(2):
+            for story in models.ConvenientStory.latest.filter(title__isnull=False).prefetch_revisions():
+                self.assertTrue(story.is_latest_revision)
+                self.assertEquals(story.latest_revision.pk, story.pk)
+                self.assertEquals([revision.pk for revision in story.revisions], bundles[story.cid])
+
     def test_convenience_shortcuts(self):
         regular = self.story
         short = models.ConvenientStory.objects.get(pk=regular.pk)
@@ -310,6 +1053,198 @@ class InheritanceTrashTests(TrashTests):
         self.story = models.FancyTrashableStory.latest.all()[0]
         self.mgr = models.FancyTrashableStory._default_manager
 
+    def test_restore(self):
+        self.story.delete()
+        trashed_story = self.mgr.trash.get(cid=self.story.cid)
+        trashed_story.restore()
+        self.assertFalse(trashed_story.is_trash)
+        for story in self.mgr.live.get(cid=self.story.cid).get_revisions():
+            self.assertFalse(story.is_trash)
+
+class BundleDeleteTests(TestCase):
+    def make_bundle(self, model, revisions):
+        story = model(title="A story")
+        story.save()
+        for i in range(revisions - 1):
+            story = story.revise()
+        return story
+
+    def assertDeletesInConstantQueries(self, model):
+        small = self.make_bundle(model, 2)
+        large = self.make_bundle(model, 6)
+        connection.use_debug_cursor = True
+        try:
+            start = len(connection.queries)
+            small.delete()
+            queries = len(connection.queries) - start
+            start = len(connection.queries)
+            large.delete()
+            self.assertEquals(len(connection.queries) - start, queries)
+        finally:
+            connection.use_debug_cursor = None
+        for story in (small, large):
+            self.assertFalse(models.Story.objects.filter(cid=story.cid).exists())
+
+    def test_delete(self):
+        self.assertDeletesInConstantQueries(models.Story)
+
+    def test_delete_inheritance(self):
+        self.assertDeletesInConstantQueries(models.FancyStory)
+
+    def test_delete_related(self):
+        story = self.make_bundle(models.Story, 3)
+        aside = models.Aside(message="An aside", story=story)
+        aside.save()
+        story.delete()
+        self.assertFalse(models.Aside.objects.filter(pk=aside.pk).exists())
+
+    def test_queryset_delete(self):
+        stories = [self.make_bundle(models.Story, 3) for i in range(3)]
+        models.Story.latest.filter(cid__in=[story.cid for story in stories[:2]]).delete()
+        self.assertFalse(models.Story.objects.filter(cid__in=[story.cid for story in stories[:2]]).exists())
+        self.assertEquals(models.Story.objects.filter(cid=stories[2].cid).count(), 3)
+
+    def test_queryset_delete_trashable(self):
+        story = self.make_bundle(models.TrashableStory, 3)
+        models.TrashableStory.latest.filter(cid=story.cid).delete()
+        self.assertEquals(models.TrashableStory.objects.filter(cid=story.cid, _is_trash=True).count(), 3)
+
+class BulkTrashTests(TestCase):
+    def setUp(self):
+        self.cids = []
+        for i in range(5):
+            story = models.TrashableStory(title="Story %i" % i)
+            story.save()
+            story.revise()
+            self.cids.append(story.cid)
+        self.fancy = models.FancyTrashableStory(title="Fancy story")
+        self.fancy.save()
+        self.fancy.revise()
+
+    def test_delete(self):
+        story = models.TrashableStory.latest.get(cid=self.cids[0])
+        # a single update for all revisions, no validation
+        with self.assertNumQueries(1):
+            story.delete()
+        self.assertEquals(models.TrashableStory.objects.filter(cid=story.cid, _is_trash=True).count(), 2)
+
+    def test_trash_and_restore(self):
+        stories = models.TrashableStory.latest.filter(title__startswith="Story")
+        with self.assertNumQueries(2):
+            self.assertEquals(stories.trash(), 5)
+        self.assertEquals(models.TrashableStory.objects.filter(cid__in=self.cids, _is_trash=True).count(), 10)
+        self.assertFalse(models.TrashableStory.objects.filter(cid=self.fancy.cid, _is_trash=True).exists())
+        self.assertEquals(models.TrashableStory.latest.trash.restore(), 5)
+        self.assertFalse(models.TrashableStory.objects.filter(_is_trash=True).exists())
+
+    def test_trash_subclass(self):
+        models.FancyTrashableStory.latest.all().trash()
+        self.assertEquals(models.FancyTrashableStory.objects.filter(_is_trash=True).count(), 2)
+        self.assertEquals(models.TrashableStory.objects.filter(_is_trash=True).count(), 2)
+
+    def test_purge(self):
+        self.assertEquals(models.TrashableStory.latest.filter(cid__in=self.cids[:3]).purge(), 3)
+        self.assertEquals(models.TrashableStory.objects.filter(cid__in=self.cids).count(), 4)
+
+    def test_purge_inheritance(self):
+        # from the subclass, which takes the parent rows along...
+        models.FancyTrashableStory.latest.all().purge()
+        self.assertFalse(models.TrashableStory.objects.filter(cid=self.fancy.cid).exists())
+        # ... and from the parent, which cascades to the subclass
+        fancy = models.FancyTrashableStory(title="Another fancy story")
+        fancy.save()
+        models.TrashableStory.latest.filter(cid=fancy.cid).purge()
+        self.assertFalse(models.FancyTrashableStory.objects.filter(cid=fancy.cid).exists())
+        self.assertEquals(models.TrashableStory.objects.count(), 10)
+
+class RegistryTests(TestCase):
+    def test_info(self):
+        info = registry.get_info(models.FancyStory)
+        self.assertEquals(info.base_model, models.Story)
+        self.assertEquals(info.base_table, 'tests_story')
+        self.assertEquals((info.comparator_name, info.comparator_table), ('vid', 'tests_story'))
+        self.assertEquals(info.clone_fields, ('cid', 'title', 'slug', 'body', 'is_very_fancy'))
+        self.assertTrue(models.FancyStory.get_versioning() is info)
+        info = registry.get_info(models.UUIDStory)
+        self.assertEquals((info.pk_name, info.comparator_name, info.comparator_table), ('alt_id', 'changed', 'tests_uuidstory'))
+        self.assertRaises(AttributeError, setattr, info, 'comparator_name', 'alt_id')
+        info = registry.get_info(models.NumberedStory)
+        self.assertEquals((info.comparator_name, info.comparator_column), ('number', 'revision_number'))
+
+    def test_get_versioned_model(self):
+        self.assertEquals(registry.get_versioned_model('tests', 'fancystory'), models.FancyStory)
+        self.assertEquals(registry.get_versioned_model('tests', 'tag'), None)
+        self.assertEquals(registry.get_versioned_model('auth', 'user'), None)
+
+    def test_latest_uses_registry(self):
+        # building a queryset shouldn't walk the inheritance chain
+        get_base_model = models.FancyStory.get_base_model
+        def fail(cls):
+            raise AssertionError("get_base_model was called")
+        models.FancyStory.get_base_model = classmethod(fail)
+        try:
+            str(models.FancyStory.latest.filter(title="A story").query)
+        finally:
+            models.FancyStory.get_base_model = get_base_model
+
+class TrashcanTests(TestCase):
+    urls = 'revisions.tests.urls'
+
+    def setUp(self):
+        self.trashed = []
+        for i in range(3):
+            story = models.TrashableStory(title="Trashed story %i" % i)
+            story.save()
+            story.revise()
+            story.delete()
+            self.trashed.append(story.cid)
+        self.fancy = models.FancyTrashableStory(title="Trashed fancy story")
+        self.fancy.save()
+        self.fancy.delete()
+        self.live = models.TrashableStory(title="Live story")
+        self.live.save()
+
+    def test_get_implementations(self):
+        trashable = models.TrashableStory.get_implementations()
+        self.assertEquals(set(trashable), set([models.TrashableStory, models.FancyTrashableStory]))
+        versioned = models.VersionedModelBase.get_implementations()
+        self.assertTrue(models.Story in versioned)
+        self.assertTrue(models.FancyTrashableStory in versioned)
+        self.assertFalse(models.ConvenientStory in versioned)
+        self.assertFalse(models.Tag in versioned)
+
+    def test_trash_index(self):
+        cursor = connection.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name = %s", 
+            [trash.get_trash_index(models.TrashableStory)])
+        self.assertTrue(cursor.fetchone())
+
+    def test_get_page(self):
+        listed = []
+        cursor = None
+        while True:
+            objects, cursor = trash.get_page([models.FancyTrashableStory, models.TrashableStory], after=cursor, limit=2)
+            self.assertTrue(len(objects) <= 2)
+            listed.extend([(model, obj.cid) for model, obj in objects])
+            if cursor is None:
+                break
+        self.assertEquals(listed, 
+            [(models.FancyTrashableStory, self.fancy.cid)] + \
+            [(models.TrashableStory, cid) for cid in sorted(self.trashed)])
+        self.assertRaises(ValueError, trash.get_page, [models.TrashableStory], after='nonsense')
+
+    def test_trashcan(self):
+        response = self.client.get('/trash/')
+        self.assertContains(response, 'Trashed fancy story')
+        self.assertContains(response, '<li>', count=2)
+        self.assertNotContains(response, 'Live story')
+        objects, cursor = trash.get_page(models.TrashableModel.get_implementations(), limit=2)
+        self.assertContains(response, '?after=%s' % urlquote(cursor))
+        response = self.client.get('/trash/', {'after': cursor})
+        self.assertContains(response, '<li>', count=2)
+        self.assertNotContains(response, 'Trashed fancy story')
+        self.assertEquals(self.client.get('/trash/', {'after': 'nonsense'}).status_code, 404)
+
 #
 # Browser tests
 #
@@ -3,9 +3,13 @@
 from django.conf.urls.defaults import *
 from django.conf import settings
 from django.contrib import admin
+from revisions.tests import models
 
 admin.autodiscover()
 
 urlpatterns = patterns('',
     (r'^admin/', include(admin.site.urls)),
+    (r'^stories/diff/(?P<compare_baseline_pk>\d+)/(?P<compare_with_pk>\d+)/$', 'revisions.views.differ', 
+        {'model': models.Story, 'paginate_by': 2, 'context': 1}),
+    (r'^trash/$', 'revisions.views.trashcan', {'paginate_by': 2}),
 )
\ No newline at end of file
@@ -0,0 +1,119 @@
+# encoding: utf-8
+
+"""
+Browsing the trash.
+
+The trash of a model consists of the latest revisions of its trashed bundles
+(or, for models that aren't versioned, simply its trashed rows.) Listings
+span many models, so rather than counting and skipping rows with OFFSET,
+which gets slower with every page, we page through them by key: trashed
+objects are ordered by model and then by bundle id (or primary key), and
+each page continues after the last object on the previous page::
+
+    objects, cursor = trash.get_page(TrashableModel.get_implementations())
+    more_objects, cursor = trash.get_page(models, after=cursor)
+
+Every query filters on ``is_trash`` and ranges over ``cid``, which is why
+``syncdb`` adds an index on ``(is_trash, cid)`` to the tables of versioned
+trashable models. For existing tables, run ``create_trash_index`` or
+create the index yourself.
+"""
+
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from revisions.models import VersionedModelBase, TrashableModel
+
+
+def get_label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.module_name)
+
+def get_key_name(model):
+    if issubclass(model, VersionedModelBase):
+        return 'cid'
+    else:
+        return model._meta.pk.name
+
+def get_trash(model):
+    """ The trashed objects of a model, ordered by key. """
+
+    if issubclass(model, VersionedModelBase):
+        qs = model.latest.filter(_is_trash=True)
+    else:
+        qs = model._default_manager.filter(_is_trash=True)
+    # with concrete inheritance, trashed objects of a subclass are trashed
+    # objects of its parent too, but they're listed under the subclass
+    for child in TrashableModel.get_implementations():
+        if model in child._meta.parents:
+            qs = qs.exclude(pk__in=child._base_manager.values_list('pk', flat=True))
+    return qs.order_by(get_key_name(model))
+
+def get_page(models, after=None, limit=20):
+    """
+    Returns up to ``limit`` trashed objects of these models as ``(model, obj)``
+    tuples, starting after the ``after`` cursor, along with the cursor for the
+    next page (or None, if this is the last page.) Raises ValueError for
+    malformed cursors.
+    """
+
+    models = sorted(models, key=get_label)
+    if after:
+        if ':' not in after:
+            raise ValueError("Not a trash cursor: %r" % after)
+        after_label, after_key = after.split(':', 1)
+    else:
+        after_label = after_key = None
+
+    objects = []
+    for model in models:
+        label = get_label(model)
+        if after_label and label < after_label:
+            continue
+        qs = get_trash(model)
+        if label == after_label:
+            qs = qs.filter(**{get_key_name(model) + '__gt': after_key})
+        # one more than we need, to know whether there's a next page
+        objects.extend([(model, obj) for obj in qs[:limit + 1 - len(objects)]])
+        if len(objects) > limit:
+            break
+
+    if len(objects) > limit:
+        objects = objects[:limit]
+        model, obj = objects[-1]
+        return objects, '%s:%s' % (get_label(model), getattr(obj, get_key_name(model)))
+    else:
+        return objects, None
+
+def get_trash_index(model):
+    return model._meta.get_field('_is_trash').model._meta.db_table + '_is_trash_cid'
+
+# how to look up an index by name, on the vendors we know how to do that for
+INDEX_LOOKUPS = {
+    'sqlite': "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = %s",
+    'postgresql': "SELECT 1 FROM pg_indexes WHERE indexname = %s",
+    'mysql': "SELECT 1 FROM information_schema.statistics WHERE table_schema = DATABASE() AND index_name = %s",
+    'oracle': "SELECT 1 FROM user_indexes WHERE index_name = UPPER(%s)",
+    }
+
+def create_trash_index(model, using=DEFAULT_DB_ALIAS):
+    """ Indexes ``(is_trash, cid)`` on the table that holds both columns,
+    unless that index already exists. Returns whether it created the index. """
+
+    is_trash = model._meta.get_field('_is_trash')
+    cid = model._meta.get_field('cid')
+    if is_trash.model is not cid.model:
+        return False
+
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    if connection.vendor not in INDEX_LOOKUPS:
+        return False
+    cursor.execute(INDEX_LOOKUPS[connection.vendor], [get_trash_index(model)])
+    if cursor.fetchone():
+        return False
+    cursor.execute('CREATE INDEX {index} ON {table} ({is_trash}, {cid})'.format(
+        index=qn(get_trash_index(model)),
+        table=qn(is_trash.model._meta.db_table),
+        is_trash=qn(is_trash.column),
+        cid=qn(cid.column)))
+    transaction.commit_unless_managed(using=using)
+    return True
@@ -1,34 +1,176 @@
 # encoding: utf-8
 
+from contextlib import contextmanager
+from django.db import connections, models, transaction
+
 try:
     from django_extensions.db.fields import CreationDateTimeField
 except:
     CreationDateTimeField = ImportError
 
+@contextmanager
+def commit_on_success_unless_managed(using):
+    """ Like ``transaction.commit_on_success``, except that inside a transaction
+    someone else manages (``commit_manually``, ``TransactionMiddleware``...) we 
+    leave it to them to commit or roll back, rather than doing it for them. """
+
+    if transaction.is_managed(using=using):
+        yield
+    else:
+        with transaction.commit_on_success(using=using):
+            yield
+
 # Since Django 1.2, a simple copy.copy(model) w/ pk = None stopped working.
 class ClonableMixin(object):
-    def clone(self):    
+    def get_duplicate(self):
+        """ An unsaved copy of this model instance. """
+
         duplicate = self.__class__()
-        for field in self._meta.fields:
-            pk = field.primary_key
-            comparator = (field.name is self.comparator_name)
-            # people expect these fields to work per-bundle, not per-revision, 
-            # so we'll overwrite these values with the old ones
-            auto_field = \
-                isinstance(field, CreationDateTimeField) or \
-                getattr(field, 'auto_now_add', False)
-
-            if not (pk or auto_field or comparator):
-                value = getattr(self, field.name)
-                setattr(duplicate, field.name, value)
-        
+        # see revisions.registry for which fields get copied
+        for attname in self.get_versioning().clone_fields:
+            setattr(duplicate, attname, getattr(self, attname))
+
+        return duplicate
+
+    def clone(self):
+        duplicate = self.get_duplicate()
         duplicate.save()
-        
-        # ... but the trick loses all ManyToMany relations.
-        for field in self._meta.many_to_many:
-            source = getattr(self, field.attname)
-            destination = getattr(duplicate, field.attname)
-            for item in source.all():
-                destination.add(item)
-
-        return duplicate
\ No newline at end of file
+
+        # ... but the trick loses all ManyToMany relations, so we copy 
+        # those over straight from the intermediary tables.
+        copy_many_to_many(self.__class__, [(self.pk, duplicate.pk)], duplicate._state.db)
+
+        return duplicate
+
+
+def is_creation_date(field):
+    """ Fields that fill themselves in when a row is inserted. """
+    return isinstance(field, CreationDateTimeField) or getattr(field, 'auto_now_add', False)
+
+def get_reference_name(relatedmanager):
+    """ The name of the relation through which objects in a related manager
+    refer to the instance it belongs to. Related managers filter on that
+    relation, e.g. ``{'story__vid': 1}``, so that's where we look. """
+    return relatedmanager.core_filters.keys()[0].split('__')[0]
+
+def get_concrete_models(model):
+    """ The tables a model instance is stored in, from the base model down. """
+
+    chain = [model]
+    while isinstance(chain[0]._meta.pk, models.OneToOneField):
+        chain.insert(0, chain[0]._meta.pk.rel.to)
+    return chain
+
+def cache_parents(instance):
+    """ With concrete inheritance, fills in the parents of a model instance 
+    from its own values, so that following its parent links takes no queries. """
+
+    for parent, link in instance._meta.parents.items():
+        if link is None:
+            continue
+        values = dict([(field.attname, instance.__dict__[field.attname]) 
+            for field in parent._meta.fields if field.attname in instance.__dict__])
+        obj = parent(**values)
+        obj._state.db = instance._state.db
+        obj._state.adding = False
+        cache_parents(obj)
+        setattr(instance, link.get_cache_name(), obj)
+
+def chunked(items, size=500):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+def bulk_insert(model, objs, using):
+    """
+    Inserts unsaved model instances using one ``executemany`` per table,
+    and sets their primary keys.
+
+    Like ``QuerySet.update``, this bypasses ``save`` and doesn't send any
+    signals. Objects need a bundle id (``cid``), and each bundle can only
+    occur once, because that's how we find the primary keys of new rows
+    when the database generates them.
+    """
+
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+
+    for level in get_concrete_models(model):
+        opts = level._meta
+        if isinstance(opts.pk, models.OneToOneField):
+            # child tables share their primary key with their parent
+            parent_pk = opts.pk.rel.to._meta.pk
+            for obj in objs:
+                setattr(obj, opts.pk.attname, getattr(obj, parent_pk.attname))
+
+        # the same columns Model.save_base would insert
+        fields = [field for field in opts.local_fields if not isinstance(field, models.AutoField)]
+        sql = 'INSERT INTO {table} ({columns}) VALUES ({placeholders})'.format(
+            table=qn(opts.db_table),
+            columns=', '.join([qn(field.column) for field in fields]),
+            placeholders=', '.join(['%s'] * len(fields)))
+        rows = [[field.get_db_prep_save(field.pre_save(obj, True), connection=connection)
+            for field in fields] for obj in objs]
+        cursor.executemany(sql, rows)
+
+        if isinstance(opts.pk, models.AutoField):
+            # new rows have the highest primary key in their bundle
+            pks = {}
+            for cids in chunked([obj.cid for obj in objs]):
+                pks.update(level._base_manager.using(using).filter(cid__in=cids) \
+                    .values_list('cid').annotate(models.Max(opts.pk.attname)))
+            for obj in objs:
+                setattr(obj, opts.pk.attname, pks[obj.cid])
+
+    for obj in objs:
+        obj._state.db = using
+        obj._state.adding = False
+
+def copy_many_to_many(model, pairs, using):
+    """
+    Copies the many-to-many relations of source instances to their
+    destinations, for a list of ``(source_pk, destination_pk)`` pairs.
+    This takes a single INSERT ... SELECT per many-to-many field, and
+    copies any extra columns on custom through models as well.
+    """
+
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+
+    for field in model._meta.many_to_many:
+        through = field.rel.through._meta
+        columns = [f.column for f in through.local_fields if not isinstance(f, models.AutoField)]
+        # symmetrical relations (to self) are stored in both directions, 
+        # so we copy the rows that point to the source as well
+        source_columns = [field.m2m_column_name()]
+        if field.rel.symmetrical:
+            source_columns.append(field.m2m_reverse_name())
+
+        for source_column in source_columns:
+            for chunk in chunked(pairs, 250):
+                mapping = 'CASE {source} {cases} END'.format(
+                    source=qn(source_column),
+                    cases=' '.join(['WHEN %s THEN %s'] * len(chunk)))
+                selection = [column == source_column and mapping or qn(column) for column in columns]
+                sql = 'INSERT INTO {table} ({columns}) SELECT {selection} FROM {table} WHERE {source} IN ({placeholders})'.format(
+                    table=qn(through.db_table),
+                    columns=', '.join([qn(column) for column in columns]),
+                    selection=', '.join(selection),
+                    source=qn(source_column),
+                    placeholders=', '.join(['%s'] * len(chunk)))
+                params = []
+                for source, destination in chunk:
+                    params.extend([source, destination])
+                params.extend([source for source, destination in chunk])
+                cursor.execute(sql, params)
+
+def bulk_clone(model, instances, using):
+    """ Like ``ClonableMixin.clone``, but for many instances at once. """
+
+    duplicates = [instance.get_duplicate() for instance in instances]
+    bulk_insert(model, duplicates, using)
+    pairs = [(instance.pk, duplicate.pk) for instance, duplicate in zip(instances, duplicates)]
+    copy_many_to_many(model, pairs, using)
+    return duplicates
@@ -1,13 +1,106 @@
-from django.views.generic import direct_to_template
-from revisions.models import VersionedModel
+from django.core.exceptions import ImproperlyConfigured
+from django.core.paginator import Paginator, InvalidPage
+from django.http import Http404, HttpResponseNotModified
+from django.shortcuts import get_object_or_404
+from django.utils.hashcompat import md5_constructor
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+from django.utils.safestring import mark_safe
+from django.views.generic.simple import direct_to_template
+from revisions import diff, trash
+from revisions.models import TrashableModel
+import time
 
-def differ(request, compare_baseline_pk, compare_with_pk):
-    raise NotImplementedError
+def differ(request, compare_baseline_pk, compare_with_pk, model=None, fields=None, 
+        template_name='revisions/differ.html', paginate_by=20, context=3):
+    """
+    Compares two revisions of the same bundle. Only the changes are shown, 
+    with ``context`` lines of unchanged text around them, ``paginate_by`` 
+    changes per page. Use ``?granularity=line`` or ``?granularity=char`` 
+    for a coarser or finer comparison than the default word diff.
 
-def trashcan(request, model=None):
-    if not model:
-        models = VersionedModel.get_implementations()
+    Pass the model in your urlconf, e.g. 
+
+        url(r'^stories/diff/(?P<compare_baseline_pk>\d+)/(?P<compare_with_pk>\d+)/$', 
+            'revisions.views.differ', {'model': Story})
+    """
+
+    if model is None:
+        raise ImproperlyConfigured("The differ view needs to know which model to compare revisions of.")
+
+    baseline = get_object_or_404(model.objects, pk=compare_baseline_pk)
+    compare_with = get_object_or_404(model.objects, pk=compare_with_pk)
+    if baseline.cid != compare_with.cid:
+        raise Http404("Can only compare revisions of the same content bundle.")
+    granularity = request.GET.get('granularity', 'word')
+    if granularity not in diff.GRANULARITIES:
+        raise Http404("Unknown granularity.")
+
+    # Revisions don't change (and if they do, their values do), so the comparators 
+    # and values of both revisions identify a diff, and tell when it last changed.
+    etag = md5_constructor()
+    for part in (model._meta, baseline.pk, compare_with.pk, baseline.comparator, compare_with.comparator, 
+            granularity, request.GET.get('page', 1)):
+        etag.update(unicode(part).encode('utf-8'))
+    for name in fields or diff.get_fields(model):
+        etag.update(unicode(getattr(baseline, name)).encode('utf-8'))
+        etag.update(unicode(getattr(compare_with, name)).encode('utf-8'))
+    etag = etag.hexdigest()
+    last_modified = None
+    comparators = [revision.comparator for revision in (baseline, compare_with)]
+    if all([hasattr(comparator, 'timetuple') for comparator in comparators]):
+        last_modified = int(time.mktime(max(comparators).timetuple()))
+
+    if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        return HttpResponseNotModified()
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    if last_modified and if_modified_since and last_modified <= if_modified_since \
+        and 'HTTP_IF_NONE_MATCH' not in request.META:
+        return HttpResponseNotModified()
+
+    changes = baseline.diff_to(compare_with, fields, granularity)
+    hunks = [(name, hunk) for name, chunks in changes for hunk in diff.hunks(chunks, context)]
+    paginator = Paginator(hunks, paginate_by, allow_empty_first_page=True)
+    try:
+        page = paginator.page(request.GET.get('page', 1))
+    except InvalidPage:
+        raise Http404("Invalid page.")
+    # only the hunks on this page are rendered
+    page.object_list = [(name, mark_safe(u''.join(diff.render_html(hunk)))) for name, hunk in page.object_list]
+
+    response = direct_to_template(request, template_name, {
+        'baseline': baseline,
+        'compare_with': compare_with,
+        'changed_fields': [name for name, chunks in changes],
+        'granularity': granularity,
+        'paginator': paginator,
+        'page': page,
+        'hunks': page.object_list,
+        })
+    response['ETag'] = quote_etag(etag)
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
+
+def trashcan(request, model=None, template_name='revisions/trashcan.html', paginate_by=20):
+    """
+    Lists trashed content, either of a single model or of every trashable
+    model, ``paginate_by`` objects per page. Pages are linked to with an 
+    ``?after=`` cursor rather than a page number, see ``revisions.trash``.
+    """
+
+    if model is None:
+        models = TrashableModel.get_implementations()
     else:
         models = [model]
-    
-    raise NotImplementedError
\ No newline at end of file
+
+    try:
+        objects, cursor = trash.get_page(models, after=request.GET.get('after'), limit=paginate_by)
+    except ValueError:
+        raise Http404("Invalid page.")
+
+    return direct_to_template(request, template_name, {
+        'models': models,
+        'objects': [(obj, model._meta.verbose_name) for model, obj in objects],
+        'after': request.GET.get('after'),
+        'next': cursor,
+        })
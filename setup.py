@@ -25,4 +25,5 @@ setup(name='django-revisions',
       download_url='http://www.github.com/stdbrouw/django-revisions/tarball/master',
       license='BSD',
       packages=find_packages(),
+      package_data={'revisions': ['templates/revisions/*.html']},
       )